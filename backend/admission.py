@@ -0,0 +1,189 @@
+"""
+分析エンドポイントのアドミッション制御
+
+- クライアントIP単位のスライディングウィンドウによるレート制限（超過時は429）
+- 全体の同時実行数の上限と、上限付きの待ち行列（満杯・待ち時間切れの場合は503）
+- 待ち行列はクライアントIPごとのラウンドロビンで処理し、1つのクライアントが枠を独占しないようにする
+  （ユーザー認証がないため、X-User-Id などの自己申告の値は使わない）
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+
+def _parse_rate(value: str) -> Tuple[int, float]:
+    """"10/60" のような「回数/秒数」の設定値を解析する"""
+    count, _, seconds = value.partition("/")
+    return int(count), float(seconds or 60)
+
+
+# 設定（環境変数で上書き可能）
+IP_RATE_LIMIT = _parse_rate(os.getenv("IP_RATE_LIMIT", "30/60"))  # IPあたり 30回/60秒
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "4"))  # 同時に処理する分析リクエスト数
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "16"))  # 待ち行列の長さ
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("QUEUE_TIMEOUT_SECONDS", "10"))  # 待ち行列での最大待ち時間
+OVERLOAD_RETRY_AFTER_SECONDS = int(os.getenv("OVERLOAD_RETRY_AFTER_SECONDS", "5"))
+
+# Cloud Runなどのプロキシ配下では X-Forwarded-For をクライアントIPの取得に使う
+# 先頭の値はクライアントが自由に書けるため、信頼できるプロキシが末尾に追加した値を使う
+# （TRUSTED_PROXY_HOPS: 末尾から何番目を使うか。Cloud Run単体は1、外部HTTPSロードバランサ経由は2）
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "false").lower() in ("1", "true", "yes")
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+# 古いキーを掃除する目安のキー数
+_PRUNE_THRESHOLD = 10_000
+
+
+class AdmissionRejected(Exception):
+    """受け付けを拒否したリクエスト"""
+
+    def __init__(self, status_code: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class SlidingWindowLimiter:
+    """キーごとに直近 window 秒間のリクエスト時刻を記録するレート制限"""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._hits: Dict[str, Deque[float]] = {}
+
+    def hit(self, key: str, now: Optional[float] = None) -> Optional[float]:
+        """
+        リクエストを記録する
+        上限を超える場合は記録せず、再試行までの秒数を返す
+        """
+        now = time.monotonic() if now is None else now
+        hits = self._hits.setdefault(key, deque())
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            return hits[0] + self.window - now
+        hits.append(now)
+        if len(self._hits) > _PRUNE_THRESHOLD:
+            self._prune(now)
+        return None
+
+    def _prune(self, now: float) -> None:
+        expired = [key for key, hits in self._hits.items() if not hits or hits[-1] <= now - self.window]
+        for key in expired:
+            del self._hits[key]
+
+
+class FairScheduler:
+    """同時実行数の上限と、キー（クライアントIP）ごとにラウンドロビンする待ち行列"""
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    async def acquire(self, key: str, timeout: float) -> None:
+        """実行枠を確保する（確保できなければ AdmissionRejected）"""
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+            return
+        if self.waiting >= self.max_queue:
+            raise AdmissionRejected(503, "サーバーが混雑しています。しばらくしてから再度お試しください。",
+                                    OVERLOAD_RETRY_AFTER_SECONDS)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self.waiting += 1
+        try:
+            await asyncio.wait({future}, timeout=timeout)
+        except asyncio.CancelledError:
+            # クライアント切断: 枠を受け取った直後なら返却し、まだなら待ち行列から外す
+            if future.done():
+                self.release()
+            else:
+                future.cancel()
+                self._remove(key, future)
+            raise
+        if not future.done():
+            # 待ち時間切れ
+            future.cancel()
+            self._remove(key, future)
+            raise AdmissionRejected(503, "サーバーが混雑しています。しばらくしてから再度お試しください。",
+                                    OVERLOAD_RETRY_AFTER_SECONDS)
+
+    def release(self) -> None:
+        """実行枠を解放し、次のキーの先頭のリクエストに枠を引き渡す"""
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                future.set_result(None)  # 枠をそのまま引き渡すので in_flight は変えない
+                return
+        self.in_flight -= 1
+
+    def _remove(self, key: str, future: asyncio.Future) -> None:
+        queue = self._queues.get(key)
+        if queue and future in queue:
+            queue.remove(future)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[key]
+
+
+class AdmissionController:
+    """レート制限と公平な同時実行制御をまとめたもの"""
+
+    def __init__(self):
+        self.ip_limiter = SlidingWindowLimiter(*IP_RATE_LIMIT)
+        self.scheduler = FairScheduler(MAX_IN_FLIGHT, MAX_QUEUE)
+        self.rejected = {429: 0, 503: 0}
+
+    async def admit(self, client_ip: str) -> None:
+        """リクエストを受け付ける。拒否する場合は AdmissionRejected を送出する"""
+        try:
+            retry_after = self.ip_limiter.hit(client_ip)
+            if retry_after is not None:
+                raise AdmissionRejected(429, "リクエストが多すぎます。しばらくしてから再度お試しください。",
+                                        max(1, math.ceil(retry_after)))
+            await self.scheduler.acquire(client_ip, QUEUE_TIMEOUT_SECONDS)
+        except AdmissionRejected as e:
+            self.rejected[e.status_code] += 1
+            raise
+
+    def release(self) -> None:
+        self.scheduler.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.scheduler.in_flight,
+            "waiting": self.scheduler.waiting,
+            "max_in_flight": self.scheduler.max_in_flight,
+            "max_queue": self.scheduler.max_queue,
+            "rejected_429": self.rejected[429],
+            "rejected_503": self.rejected[503],
+        }
+
+
+def client_ip_from(headers, client_host: Optional[str], trust_forwarded_for: bool = TRUST_FORWARDED_FOR,
+                   trusted_hops: int = TRUSTED_PROXY_HOPS) -> str:
+    """リクエストのクライアントIPを取得する"""
+    if trust_forwarded_for:
+        entries = [entry.strip() for entry in headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if entries:
+            # 経由したプロキシより手前（クライアント側）の値は信用しない
+            return entries[-min(trusted_hops, len(entries))]
+    return client_host or "unknown"
+
+
+# アプリ全体で共有するアドミッション制御
+admission_controller = AdmissionController()
@@ -0,0 +1,319 @@
+"""
+meal_images の一括再分析（バックフィル）スクリプト
+
+プロンプトやモデルを変更したときに、既存の分析結果を再実行して書き戻す。
+- キーセットページネーション（created_at, id）で行を順に取得
+- コネクションプール付きのセッションで画像を取得
+- 同時実行数とレート（1分あたりのリクエスト数）を制限して分析
+- ページ単位でまとめて書き戻し（bulk_update_analysis 関数で既存の行だけを更新）し、チェックポイントを保存
+  （異常終了しても --checkpoint のファイルから再開できる）
+- 失敗した行のIDはチェックポイントに記録し、--retry-failed で再実行できる
+
+使い方:
+    python backfill.py --only-stale --concurrency 4 --rpm 60
+    python backfill.py --dry-run --limit 10
+    python backfill.py --retry-failed
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from image_validation import ImageValidationError, download_image, validate_image
+from meal_analysis import run_analysis
+from model_router import model_router, ROUTING_POLICIES
+from prompt_registry import prompt_registry
+
+# Supabase接続情報
+# anonキーはRLSによりSELECTできず、0件のまま「完了」してしまうため、サービスキーを必須とする
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY", "")
+
+# Supabase APIヘッダー
+supabase_headers = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Content-Type": "application/json",
+}
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(__file__), "backfill_checkpoint.json")
+
+ROW_COLUMNS = "id,filename,public_url,created_at,prompt_version"
+
+
+class BackfillError(Exception):
+    """バックフィルを続行できないエラー"""
+
+
+class RateLimiter:
+    """トークンバケット方式のレート制限（スレッドセーフ）"""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def acquire(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """コネクションプール付きのセッションを作成する"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def new_checkpoint() -> Dict[str, Any]:
+    return {"cursor": None, "processed": 0, "updated": 0, "failed": 0, "failed_ids": []}
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    checkpoint = new_checkpoint()
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            checkpoint.update(json.load(f))
+    return checkpoint
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    """書き込み途中で落ちても壊れないよう、一時ファイル経由で置き換える"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def fetch_page(session: requests.Session, cursor: Optional[Dict[str, str]], page_size: int,
+               stale_version: Optional[str]) -> List[Dict[str, Any]]:
+    """(created_at, id) のキーセットで次のページを取得する"""
+    params = {
+        "select": ROW_COLUMNS,
+        "public_url": "like.http*",
+        "order": "created_at.asc,id.asc",
+        "limit": str(page_size),
+    }
+    conditions = []
+    if cursor:
+        conditions.append(
+            f"or(created_at.gt.\"{cursor['created_at']}\","
+            f"and(created_at.eq.\"{cursor['created_at']}\",id.gt.{cursor['id']}))"
+        )
+    if stale_version:
+        conditions.append(f"or(prompt_version.is.null,prompt_version.neq.{stale_version})")
+    if conditions:
+        params["and"] = f"({','.join(conditions)})"
+
+    response = session.get(f"{SUPABASE_URL}/rest/v1/meal_images", headers=supabase_headers,
+                           params=params, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_rows_by_id(session: requests.Session, ids: List[Any]) -> List[Dict[str, Any]]:
+    """指定したIDの行を取得する（削除済みの行は返らない）"""
+    params = {
+        "select": ROW_COLUMNS,
+        "id": f"in.({','.join(str(row_id) for row_id in ids)})",
+        "order": "created_at.asc,id.asc",
+    }
+    response = session.get(f"{SUPABASE_URL}/rest/v1/meal_images", headers=supabase_headers,
+                           params=params, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+
+def analyze_row(session: requests.Session, limiter: RateLimiter, row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """1行分の画像を取得して再分析する（失敗時は None）"""
+    try:
+        image_data = download_image(row["public_url"], session=session, timeout=30)
+        image_info = validate_image(image_data)
+
+        # エスカレーション時は2回呼び出すため、レート制限は呼び出しごとに行う
+        analysis = run_analysis("advice", image_data, image_info.mime_type, before_call=limiter.acquire)
+        return {
+            "id": row["id"],
+            "filename": row["filename"],
+            "public_url": row["public_url"],
+            "analysis_result": analysis.text,
+            "prompt_version": analysis.prompt_version,
+        }
+    except ImageValidationError as e:
+        print(f"⚠️ {row['id']}: 画像の検証に失敗: {e.message}")
+    except Exception as e:
+        print(f"❌ {row['id']}: 再分析に失敗: {e}")
+    return None
+
+
+def bulk_update(session: requests.Session, rows: List[Dict[str, Any]]) -> int:
+    """
+    再分析結果をまとめて書き戻し、更新した行数を返す
+    upsertと違い、実行中に削除された行を再作成しない（db_setup.sql の bulk_update_analysis）
+    """
+    if not rows:
+        return 0
+    updates = [
+        {"id": row["id"], "analysis_result": row["analysis_result"], "prompt_version": row["prompt_version"]}
+        for row in rows
+    ]
+    response = session.post(f"{SUPABASE_URL}/rest/v1/rpc/bulk_update_analysis", headers=supabase_headers,
+                            json={"updates": updates}, timeout=60)
+    if response.status_code in (401, 403, 404):
+        raise BackfillError(
+            f"一括更新が拒否されました（{response.status_code}）: {response.text[:200]}\n"
+            "SUPABASE_SERVICE_KEY と、db_setup.sql の bulk_update_analysis 関数を確認してください"
+        )
+    response.raise_for_status()
+    updated = int(response.json() or 0)
+    if updated == 0:
+        raise BackfillError(f"{len(rows)}件の更新を送信しましたが、1件も更新されませんでした（権限を確認してください）")
+    if updated < len(rows):
+        print(f"⚠️ {len(rows) - updated}件は実行中に削除されたため更新されませんでした")
+    return updated
+
+
+def process_rows(executor: ThreadPoolExecutor, session: requests.Session, limiter: RateLimiter,
+                 rows: List[Dict[str, Any]], dry_run: bool):
+    """行をまとめて再分析して書き戻し、(更新件数, 失敗した行のID) を返す"""
+    results = list(executor.map(lambda row: analyze_row(session, limiter, row), rows))
+    updates = [result for result in results if result]
+    failed_ids = [row["id"] for row, result in zip(rows, results) if not result]
+
+    updated = len(updates)
+    if not dry_run:
+        updated = bulk_update(session, updates)
+    return updated, failed_ids
+
+
+def retry_failed(args, checkpoint: Dict[str, Any], session: requests.Session, limiter: RateLimiter,
+                 executor: ThreadPoolExecutor) -> int:
+    """チェックポイントに記録された失敗行だけを再実行する（カーソルは動かさない）"""
+    pending = list(checkpoint["failed_ids"])
+    if args.limit is not None:
+        pending = pending[:args.limit]
+    print(f"🔁 失敗した{len(pending)}件を再実行します")
+
+    processed = 0
+    for offset in range(0, len(pending), args.page_size):
+        ids = pending[offset:offset + args.page_size]
+        rows = fetch_rows_by_id(session, ids)
+        updated, failed_ids = process_rows(executor, session, limiter, rows, args.dry_run)
+
+        # 成功した行と、削除済みで取得できなかった行は記録から外す
+        still_failed = set(failed_ids)
+        done = set(ids) - still_failed
+        checkpoint["failed_ids"] = [row_id for row_id in checkpoint["failed_ids"] if row_id not in done]
+        checkpoint["updated"] += updated
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, checkpoint)
+
+        processed += len(rows)
+        print(f"📦 {len(rows)}件再実行 ({updated}件更新, {len(failed_ids)}件は再び失敗)")
+    return processed
+
+
+def run_backfill(args) -> None:
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise BackfillError("SUPABASE_URL と SUPABASE_SERVICE_KEY を設定してください（anonキーでは行を取得できません）")
+    if args.policy:
+        model_router.set_policy(args.policy)
+
+    checkpoint = new_checkpoint() if args.restart else load_checkpoint(args.checkpoint)
+    stale_version = prompt_registry.get("advice").version_id if args.only_stale else None
+
+    print("="*60)
+    print("🔁 meal_images バックフィル開始")
+    print(f"   - プロンプト: {prompt_registry.get('advice').version_id}")
+    print(f"   - ルーティングポリシー: {model_router.policy}")
+    print(f"   - 同時実行数: {args.concurrency}, レート上限: {args.rpm}/分, ページサイズ: {args.page_size}")
+    if checkpoint["cursor"]:
+        print(f"   - チェックポイントから再開: {checkpoint['cursor']} (処理済み {checkpoint['processed']}件)")
+    if checkpoint["failed_ids"]:
+        print(f"   - 失敗した行: {len(checkpoint['failed_ids'])}件（--retry-failed で再実行できます）")
+    print("="*60)
+
+    session = create_session(args.concurrency + 2)
+    limiter = RateLimiter(args.rpm)
+    start = time.perf_counter()
+    processed_this_run = 0
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        if args.retry_failed:
+            processed_this_run = retry_failed(args, checkpoint, session, limiter, executor)
+
+        while not args.retry_failed and (args.limit is None or processed_this_run < args.limit):
+            page_size = args.page_size if args.limit is None else min(args.page_size, args.limit - processed_this_run)
+            rows = fetch_page(session, checkpoint["cursor"], page_size, stale_version)
+            if not rows:
+                if not processed_this_run and not checkpoint["cursor"] and not args.only_stale:
+                    print("⚠️ 対象の行が1件も取得できませんでした。テーブルが空か、キーの権限が不足しています")
+                break
+
+            page_start = time.perf_counter()
+            updated, failed_ids = process_rows(executor, session, limiter, rows, args.dry_run)
+
+            # ページ単位でチェックポイントを進める（失敗した行はIDを記録して後から再実行する）
+            last = rows[-1]
+            checkpoint["cursor"] = {"created_at": last["created_at"], "id": last["id"]}
+            checkpoint["processed"] += len(rows)
+            checkpoint["updated"] += updated
+            checkpoint["failed"] += len(failed_ids)
+            checkpoint["failed_ids"] += [row_id for row_id in failed_ids if row_id not in checkpoint["failed_ids"]]
+            if not args.dry_run:
+                save_checkpoint(args.checkpoint, checkpoint)
+
+            processed_this_run += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"📦 {len(rows)}件処理 ({updated}件更新) "
+                  f"ページ {time.perf_counter() - page_start:.1f}s / 累計 {processed_this_run}件 "
+                  f"{processed_this_run / elapsed:.2f}件/s")
+
+    elapsed = time.perf_counter() - start
+    print("="*60)
+    print(f"🏁 バックフィル完了: {processed_this_run}件 / {elapsed:.1f}s "
+          f"({processed_this_run / elapsed if elapsed else 0:.2f}件/s)")
+    print(f"   - 累計: 処理 {checkpoint['processed']}件, 更新 {checkpoint['updated']}件, 失敗 {checkpoint['failed']}件")
+    print(f"   - 未解決の失敗: {len(checkpoint['failed_ids'])}件")
+    print(f"   - モデル統計: {json.dumps(model_router.stats()['models'], ensure_ascii=False)}")
+    print("="*60)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="meal_images の分析結果を一括で再実行する")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に分析する件数")
+    parser.add_argument("--rpm", type=float, default=60, help="OpenAI APIへの1分あたりのリクエスト上限（0で無制限）")
+    parser.add_argument("--page-size", type=int, default=50, help="1ページあたりの取得件数")
+    parser.add_argument("--limit", type=int, default=None, help="今回処理する最大件数")
+    parser.add_argument("--only-stale", action="store_true", help="現在のプロンプトバージョンで分析されていない行のみ対象")
+    parser.add_argument("--policy", choices=ROUTING_POLICIES, help="モデルルーティングポリシー")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="チェックポイントファイルのパス")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から実行")
+    parser.add_argument("--retry-failed", action="store_true", help="チェックポイントに記録された失敗行だけを再実行")
+    parser.add_argument("--dry-run", action="store_true", help="分析のみ行い、書き戻さない")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        run_backfill(parse_args())
+    except BackfillError as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
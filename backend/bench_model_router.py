@@ -0,0 +1,53 @@
+"""
+モデルルーティングポリシーのベンチマーク用スクリプト
+
+OPENAI_BASE_URL に偽のOpenAIサーバー（例: http://localhost:8080/v1）を指定すると、
+課金なしで各ポリシーのレイテンシ・トークン数・推定コストを比較できる。
+
+使い方:
+    OPENAI_BASE_URL=http://localhost:8080/v1 OPENAI_API_KEY=dummy python bench_model_router.py [回数]
+"""
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from image_validation import validate_image
+from meal_analysis import run_analysis
+from model_router import ModelRouter, ROUTING_POLICIES
+from prompt_registry import prompt_registry
+
+# テスト用画像
+IMAGE_PATH = os.getenv("BENCH_IMAGE", os.path.join(os.path.dirname(__file__), "..", "test_images", "meal.jpg"))
+
+
+def run_benchmark(iterations):
+    with open(IMAGE_PATH, "rb") as f:
+        image_data = f.read()
+    image_info = validate_image(image_data)
+    prompt = prompt_registry.get("advice")
+
+    print(f"接続先: {os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')}")
+    print(f"画像: {IMAGE_PATH} ({image_info.format}, {len(image_data)} bytes), 回数: {iterations}")
+    print(f"プロンプト: {prompt.version_id} ({prompt.token_count} tokens)")
+
+    for policy in ROUTING_POLICIES:
+        router = ModelRouter(policy=policy)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            # 本番と同じ分析処理（プロンプト・max_tokens・見出し）をポリシーごとのルーターで実行する
+            run_analysis("advice", image_data, image_info.mime_type, router=router)
+        elapsed = time.perf_counter() - start
+        stats = router.stats()
+        print("="*60)
+        print(f"📊 ポリシー: {policy}  合計 {elapsed:.2f}s  ({elapsed / iterations * 1000:.0f}ms/回)")
+        for model, s in stats["models"].items():
+            print(f"   - {model}: {s}")
+        print(f"   - 合計コスト: ${stats['total_cost_usd']}")
+
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,120 @@
+"""
+起動時間のベンチマーク用スクリプト
+
+- python -X importtime による main モジュールのインポート時間
+- プロセス（またはコンテナ）起動から GET / が 200 を返すまでのコールドスタート時間
+
+使い方:
+    python bench_startup.py                              # ローカルで uvicorn を起動して計測
+    python bench_startup.py --image gcr.io/meal-checker/meal-checker-api   # コンテナで計測
+    python bench_startup.py --label after --output benchmarks/startup_local.md   # 結果を追記
+    python bench_startup.py --image gcr.io/meal-checker/meal-checker-api --label container \
+        --output benchmarks/startup_container.md   # コンテナの結果は別ファイルに追記
+"""
+import argparse
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+UVICORN_ARGS = ["--loop", "uvloop", "--http", "httptools", "--no-access-log"]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_importtime(runs: int):
+    """import main の累積インポート時間（ms）と、重いモジュールの上位を返す"""
+    totals = []
+    modules = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=BACKEND_DIR, capture_output=True, text=True
+        )
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|").split("|")]
+            if name == "main":
+                totals.append(int(cumulative_us) / 1000)
+            modules.setdefault(name, []).append(int(self_us) / 1000)
+    heaviest = sorted(((statistics.median(v), k) for k, v in modules.items()), reverse=True)[:10]
+    return statistics.median(totals), heaviest
+
+
+def measure_cold_start(runs: int, image: str = None, timeout: float = 60.0):
+    """起動から GET / が 200 を返すまでの時間（ms）"""
+    samples = []
+    for _ in range(runs):
+        port = _free_port()
+        if image:
+            command = ["docker", "run", "--rm", "-d", "-p", f"{port}:8000", "-e", "PORT=8000", image]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), *UVICORN_ARGS]
+
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        container_id = process.communicate()[0].strip() if image else None
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if requests.get(f"http://127.0.0.1:{port}/", timeout=0.5).status_code == 200:
+                        samples.append((time.perf_counter() - start) * 1000)
+                        break
+                except requests.RequestException:
+                    time.sleep(0.01)
+        finally:
+            if image:
+                subprocess.run(["docker", "rm", "-f", container_id], capture_output=True)
+            else:
+                process.terminate()
+                process.wait()
+    return statistics.median(samples) if samples else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間を計測する")
+    parser.add_argument("--runs", type=int, default=5, help="計測回数（中央値を採用）")
+    parser.add_argument("--image", help="計測するコンテナイメージ（省略時はローカルで uvicorn を起動）")
+    parser.add_argument("--label", default="current", help="レポートに付けるラベル")
+    parser.add_argument("--output", help="Markdownレポートを追記するファイル")
+    args = parser.parse_args()
+
+    import_ms, heaviest = measure_importtime(args.runs)
+    cold_start_ms = measure_cold_start(args.runs, image=args.image)
+    target = f"コンテナ `{args.image}`" if args.image else f"ローカル uvicorn ({' '.join(UVICORN_ARGS)})"
+
+    lines = [
+        f"## {args.label}",
+        "",
+        f"- 計測日時: {datetime.now().isoformat(timespec='seconds')}",
+        f"- Python: {platform.python_version()} / {platform.system()} ({args.runs}回の中央値)",
+        f"- `import main`: {import_ms:.0f} ms",
+        f"- コールドスタート（{target} → GET / が 200）: "
+        + (f"{cold_start_ms:.0f} ms" if cold_start_ms is not None else "タイムアウト"),
+        "",
+        "| モジュール | self (ms) |",
+        "| ---------- | --------- |",
+        *[f"| `{name}` | {ms:.1f} |" for ms, name in heaviest],
+        "",
+    ]
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
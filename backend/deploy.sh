@@ -20,8 +20,10 @@ gcloud run deploy ${SERVICE_NAME} \
   --platform managed \
   --region ${REGION} \
   --allow-unauthenticated \
+  --cpu-boost \
   --set-env-vars="SUPABASE_URL=$(grep SUPABASE_URL ../.env | cut -d '=' -f2)" \
   --set-env-vars="SUPABASE_KEY=$(grep SUPABASE_KEY ../.env | cut -d '=' -f2)" \
-  --set-env-vars="OPENAI_API_KEY=$(grep OPENAI_API_KEY ../.env | cut -d '=' -f2)"
+  --set-env-vars="OPENAI_API_KEY=$(grep OPENAI_API_KEY ../.env | cut -d '=' -f2)" \
+  --set-env-vars="TRUST_FORWARDED_FOR=true"
 
 echo "✅ デプロイ完了！" 
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+画像アップロードの事前検証
+
+base64化やOpenAI APIの呼び出しといった高コストな処理の前に、
+マジックバイトによる形式判定とヘッダーからの寸法読み取り（画像全体はデコードしない）を行い、
+巨大なファイルや解凍爆弾（decompression bomb）を早期に拒否する。
+"""
+import os
+import re
+import struct
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import requests
+
+# 上限値（環境変数で上書き可能）
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))  # 10MB
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))  # 4000万画素
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "12000"))
+
+# multipartの境界やヘッダー分の余裕（Content-Lengthによる早期拒否に使用）
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# OpenAI Vision APIが受け付ける形式: 形式名 -> (MIMEタイプ, 拡張子)
+SUPPORTED_FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg"),
+    "png": ("image/png", ".png"),
+    "webp": ("image/webp", ".webp"),
+    "gif": ("image/gif", ".gif"),
+}
+
+# 寸法を持つJPEGのSOFマーカー（DHT/JPG/DACを除くC0〜CF）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageValidationError(Exception):
+    """検証エラー（status_code は対応するHTTPステータス）"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+@dataclass(frozen=True)
+class ValidatedImage:
+    """検証済み画像の情報"""
+    format: str
+    width: int
+    height: int
+    size: int
+
+    @property
+    def mime_type(self) -> str:
+        return SUPPORTED_FORMATS[self.format][0]
+
+    @property
+    def extension(self) -> str:
+        return SUPPORTED_FORMATS[self.format][1]
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """先頭のマジックバイトから画像形式を判定する"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return None
+
+
+def _png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def _gif_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 10:
+        return None
+    return struct.unpack("<HH", data[6:10])
+
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30 and data[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25 and data[20] == 0x2F:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    return None
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """JPEGのマーカーを順にたどり、SOFセグメントから寸法を読む"""
+    i = 2
+    length = len(data)
+    while i + 1 < length:
+        if data[i] != 0xFF:
+            return None
+        # フィルバイト（連続する0xFF）を読み飛ばす
+        while i < length and data[i] == 0xFF:
+            i += 1
+        if i >= length:
+            return None
+        marker = data[i]
+        i += 1
+        # 長さを持たないマーカー（TEM, RST0〜7）
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        # SOS/EOI に達した場合は寸法なし
+        if marker in (0xDA, 0xD9) or i + 2 > length:
+            return None
+        segment_length = struct.unpack(">H", data[i:i + 2])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 7 > length:
+                return None
+            height, width = struct.unpack(">HH", data[i + 3:i + 7])
+            return width, height
+        i += segment_length
+    return None
+
+
+_SIZE_READERS = {
+    "jpeg": _jpeg_size,
+    "png": _png_size,
+    "webp": _webp_size,
+    "gif": _gif_size,
+}
+
+
+def read_dimensions(data: bytes, image_format: str) -> Optional[Tuple[int, int]]:
+    """画像全体をデコードせずにヘッダーから (幅, 高さ) を読み取る"""
+    return _SIZE_READERS[image_format](data)
+
+
+def check_content_length(content_length: Optional[str], limit: int = MAX_IMAGE_BYTES + MULTIPART_OVERHEAD_BYTES) -> None:
+    """Content-Lengthヘッダーだけで、本文を読む前に過大なリクエストを拒否する"""
+    if content_length is None:
+        return
+    try:
+        size = int(content_length)
+    except ValueError:
+        raise ImageValidationError("Content-Lengthが不正です", status_code=400)
+    if size > limit:
+        raise ImageValidationError(
+            f"ファイルサイズが大きすぎます（上限 {MAX_IMAGE_BYTES // (1024 * 1024)}MB）", status_code=413
+        )
+
+
+def validate_image(data: bytes) -> ValidatedImage:
+    """
+    画像のバイト列を検証する
+    - サイズ上限、対応形式（マジックバイト）、寸法・総画素数の上限
+    """
+    size = len(data)
+    if size == 0:
+        raise ImageValidationError("画像データが空です", status_code=400)
+    if size > MAX_IMAGE_BYTES:
+        raise ImageValidationError(
+            f"ファイルサイズが大きすぎます（上限 {MAX_IMAGE_BYTES // (1024 * 1024)}MB）", status_code=413
+        )
+
+    image_format = sniff_format(data)
+    if image_format is None:
+        raise ImageValidationError("対応していない画像形式です（JPEG / PNG / WebP / GIF のみ）", status_code=415)
+
+    dimensions = read_dimensions(data, image_format)
+    if not dimensions or not all(dimensions):
+        raise ImageValidationError("画像の寸法を読み取れませんでした", status_code=400)
+
+    width, height = dimensions
+    if width > MAX_IMAGE_SIDE or height > MAX_IMAGE_SIDE or width * height > MAX_IMAGE_PIXELS:
+        raise ImageValidationError(f"画像の解像度が大きすぎます（{width}x{height}）", status_code=413)
+
+    return ValidatedImage(format=image_format, width=width, height=height, size=size)
+
+
+def safe_filename(filename: Optional[str], extension: str) -> str:
+    """クライアントから送られたファイル名を、パスとして安全な名前に変換する"""
+    base = os.path.basename((filename or "").replace("\\", "/"))
+    stem = os.path.splitext(base)[0]
+    stem = re.sub(r"[^A-Za-z0-9_-]", "_", stem)[:64].strip("_") or "image"
+    return f"{stem}{extension}"
+
+
+def download_image(url: str, session=None, timeout: int = 10) -> bytes:
+    """
+    画像をダウンロードする（上限サイズを超える場合は途中で打ち切る）
+    sessionを渡すとコネクションプールを再利用する
+    """
+    client = session or requests
+    with client.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        check_content_length(response.headers.get("Content-Length"), limit=MAX_IMAGE_BYTES)
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk)
+            received += len(chunk)
+            if received > MAX_IMAGE_BYTES:
+                break
+    return b"".join(chunks)
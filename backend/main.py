@@ -1,10 +1,17 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
 import os
-import base64
+import hmac
+import hashlib
 from dotenv import load_dotenv
-import openai
 from typing import Dict, Any, Optional
+from contextlib import asynccontextmanager
+import threading
+import asyncio
 from pydantic import BaseModel
 import re
 import requests
@@ -12,12 +19,128 @@ from io import BytesIO
 import uuid
 from datetime import datetime
 import json
+from urllib.parse import unquote
 
 load_dotenv()
 
-app = FastAPI()
+from model_router import model_router, resolve_user_tier, OPENAI_MODEL, ROUTING_POLICIES
+from prompt_registry import prompt_registry
+from meal_analysis import run_analysis
+from admission import AdmissionRejected, admission_controller, client_ip_from
+from renditions import collect_renditions, discard_renditions, rendition_paths, start_renditions
+from image_validation import (
+    MAX_IMAGE_BYTES, MULTIPART_OVERHEAD_BYTES, ImageValidationError, check_content_length, download_image,
+    safe_filename, validate_image
+)
+
+def warm_up():
+    """接続確認と、重いモジュール（OpenAI SDK・トークナイザー）の読み込みを行う"""
+    check_supabase_connection()
+    model_router.warm_up()
+    prompt_registry.warm_up()
+    print("🔥 ウォームアップ完了")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ポートをすぐに開けるよう、ウォームアップはバックグラウンドスレッドで行う
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# 画像を直接受け取るエンドポイント
+UPLOAD_PATHS = {"/analyze-direct", "/api/analyze"}
+
+class UploadTooLarge(StarletteHTTPException):
+    """アップロード本文の受信中に上限を超えた"""
+
+    def __init__(self):
+        super().__init__(status_code=413, detail=f"ファイルサイズが大きすぎます（上限 {MAX_IMAGE_BYTES // (1024 * 1024)}MB）")
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request: Request, exc: UploadTooLarge):
+    return JSONResponse(status_code=exc.status_code, content={"error": True, "message": exc.detail})
+
+class UploadSizeLimitMiddleware:
+    """
+    アップロードの本文サイズを制限する
+    - Content-Lengthがあれば、本文を読む前に拒否する
+    - chunked転送などContent-Lengthがない場合も、受信したバイト数を数えて上限を超えた時点で打ち切る
+      （multipartの解析で本文全体がメモリ・ディスクに溜め込まれる前に止める）
+    """
+
+    def __init__(self, app, limit: int = MAX_IMAGE_BYTES + MULTIPART_OVERHEAD_BYTES):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPLOAD_PATHS:
+            return await self.app(scope, receive, send)
+
+        try:
+            check_content_length(Headers(scope=scope).get("content-length"), limit=self.limit)
+        except ImageValidationError as e:
+            response = JSONResponse(status_code=e.status_code, content={"error": True, "message": e.message})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    print(f"⚠️ アップロードが上限を超えたため受信を打ち切ります: {received} バイト")
+                    raise UploadTooLarge()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+# レート制限・同時実行数の制限をかける分析エンドポイント
+ANALYSIS_PATHS = {"/analyze"} | UPLOAD_PATHS
+
+class AdmissionMiddleware:
+    """
+    IP単位のレート制限と、同時実行数の上限・公平な待ち行列を適用する
+    混雑時は待たせ続けずに 429 / 503 と Retry-After を返す
+    （BaseHTTPMiddleware だと receive がタスクグループで包まれ、本文受信中の UploadTooLarge が
+    フォーム解析で 400 に変換されてしまうため、ASGIミドルウェアとして実装する）
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in ANALYSIS_PATHS:
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        client_ip = client_ip_from(Headers(scope=scope), client[0] if client else None)
+        # ユーザー認証がないため、レート制限・待ち行列の公平性はクライアントIP単位で行う
+        # （X-User-Id などの自己申告のヘッダーは使わない）
+        try:
+            await admission_controller.admit(client_ip)
+        except AdmissionRejected as e:
+            print(f"🚦 リクエストを拒否: {e.status_code} (ip={client_ip}) {admission_controller.stats()}")
+            response = JSONResponse(
+                status_code=e.status_code,
+                content={"error": True, "message": e.message},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_controller.release()
 
-# CORS設定
+app.add_middleware(AdmissionMiddleware)
+
+# サイズ超過のアップロードはレート制限や待ち行列より前（外側）ですぐに拒否するため、
+# アドミッション制御の後に追加する（後から追加したミドルウェアほど外側で実行される）
+app.add_middleware(UploadSizeLimitMiddleware)
+
+# CORS設定（アップロード拒否のレスポンスにもCORSヘッダーを付けるため最後に追加する）
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -31,7 +154,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Type", "X-Requested-With", "Authorization"],
+    expose_headers=["Content-Type", "X-Requested-With", "Authorization", "Retry-After"],
 )
 
 # Supabase接続情報
@@ -46,87 +169,101 @@ supabase_headers = {
 }
 
 # Supabase接続チェック
-supabase_available = False
-try:
-    # 簡単な接続テスト - より信頼性の高いエンドポイントを使用
-    response = requests.get(
-        f"{SUPABASE_URL}/rest/v1/meal_images?limit=1",
-        headers=supabase_headers
-    )
-    print(f"🔍 Supabase接続テスト結果: ステータスコード {response.status_code}")
-    print(f"🔍 レスポンス内容: {response.text[:100]}")
-    
-    if response.status_code in [200, 201, 204]:
-        print("✅ Supabase接続成功")
-        supabase_available = True
-    elif response.status_code == 404:
-        print("❌ テーブルが存在しない可能性があります。テーブルを作成します。")
-        # テーブル作成のSQLを実行
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS meal_images (
-            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-            filename TEXT NOT NULL,
-            public_url TEXT NOT NULL,
-            analysis_result TEXT,
-            created_at TIMESTAMPTZ DEFAULT NOW(),
-            user_id UUID REFERENCES auth.users(id)
-        );
-        ALTER TABLE meal_images ENABLE ROW LEVEL SECURITY;
-        CREATE POLICY "Everyone can insert" ON meal_images FOR INSERT TO anon WITH CHECK (true);
-        CREATE POLICY "Everyone can select" ON meal_images FOR SELECT TO anon USING (true);
-        """
-        
-        # SQL実行エンドポイントを利用
-        sql_response = requests.post(
-            f"{SUPABASE_URL}/rest/v1/rpc/execute_sql",
-            headers=supabase_headers,
-            json={"query": create_table_sql}
-        )
-        
-        print(f"テーブル作成レスポンス: {sql_response.status_code} - {sql_response.text}")
-        
-        # 再度テーブル存在確認
-        check_again_response = requests.get(
+def check_supabase_connection():
+    """
+    Supabaseへの接続を確認し、テーブルがなければ作成を試みる
+    （起動をブロックしないよう、起動時にバックグラウンドで実行する）
+    """
+    global supabase_available
+    try:
+        # 簡単な接続テスト - より信頼性の高いエンドポイントを使用
+        response = requests.get(
             f"{SUPABASE_URL}/rest/v1/meal_images?limit=1",
             headers=supabase_headers
         )
-        if check_again_response.status_code in [200, 201, 204]:
-            print("✅ テーブル作成または確認成功")
+        print(f"🔍 Supabase接続テスト結果: ステータスコード {response.status_code}")
+        print(f"🔍 レスポンス内容: {response.text[:100]}")
+    
+        if response.status_code in [200, 201, 204]:
+            print("✅ Supabase接続成功")
             supabase_available = True
+        elif response.status_code == 404:
+            print("❌ テーブルが存在しない可能性があります。テーブルを作成します。")
+            # テーブル作成のSQLを実行
+            create_table_sql = """
+            CREATE TABLE IF NOT EXISTS meal_images (
+                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                filename TEXT NOT NULL,
+                public_url TEXT NOT NULL,
+                analysis_result TEXT,
+                prompt_version TEXT,
+                thumbnail_url TEXT,
+                medium_url TEXT,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                user_id UUID REFERENCES auth.users(id)
+            );
+            ALTER TABLE meal_images ENABLE ROW LEVEL SECURITY;
+            CREATE POLICY "Everyone can insert" ON meal_images FOR INSERT TO anon WITH CHECK (true);
+            CREATE POLICY "Everyone can select" ON meal_images FOR SELECT TO anon USING (true);
+            """
+        
+            # SQL実行エンドポイントを利用
+            sql_response = requests.post(
+                f"{SUPABASE_URL}/rest/v1/rpc/execute_sql",
+                headers=supabase_headers,
+                json={"query": create_table_sql}
+            )
+        
+            print(f"テーブル作成レスポンス: {sql_response.status_code} - {sql_response.text}")
+        
+            # 再度テーブル存在確認
+            check_again_response = requests.get(
+                f"{SUPABASE_URL}/rest/v1/meal_images?limit=1",
+                headers=supabase_headers
+            )
+            if check_again_response.status_code in [200, 201, 204]:
+                print("✅ テーブル作成または確認成功")
+                supabase_available = True
+            else:
+                print(f"❌ テーブル作成または確認失敗: {check_again_response.status_code}")
+                # 強制的に有効化
+                supabase_available = True
         else:
-            print(f"❌ テーブル作成または確認失敗: {check_again_response.status_code}")
-            # 強制的に有効化
+            print(f"❌ Supabase接続エラー: ステータスコード {response.status_code}, レスポンス: {response.text}")
+            # エラーでも強制的に有効にする（緊急措置）
+            print("⚠️ 警告: 接続エラーがありますが、強制的にSupabaseを有効化します")
             supabase_available = True
-    else:
-        print(f"❌ Supabase接続エラー: ステータスコード {response.status_code}, レスポンス: {response.text}")
+    except Exception as e:
+        print(f"❌ Supabase接続エラー: {e}")
         # エラーでも強制的に有効にする（緊急措置）
         print("⚠️ 警告: 接続エラーがありますが、強制的にSupabaseを有効化します")
         supabase_available = True
-except Exception as e:
-    print(f"❌ Supabase接続エラー: {e}")
-    # エラーでも強制的に有効にする（緊急措置）
-    print("⚠️ 警告: 接続エラーがありますが、強制的にSupabaseを有効化します")
-    supabase_available = True
 
 # 強制的に有効化
 print("✅✅✅ Supabaseを強制的に有効化しました")
 supabase_available = True
 
-# OpenAIクライアントの初期化（APIキーがない場合はスキップ）
+# OpenAI APIキー（SDKは環境変数 OPENAI_API_KEY を直接読み込む）
 openai_api_key = os.getenv("OPENAI_API_KEY")
-if openai_api_key:
-    openai.api_key = openai_api_key
 
 # 一時ファイル保存用のディレクトリ設定
 app.config = type('', (), {})()
 app.config.temp_file_dir = os.path.join(os.path.dirname(__file__), "temp")
 os.makedirs(app.config.temp_file_dir, exist_ok=True)
 
+# モデルルーティング設定変更用の管理トークン（未設定の場合は変更不可）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 class ImageUrlRequest(BaseModel):
     image_url: str
 
+class RoutingPolicyRequest(BaseModel):
+    policy: str
+    reset_stats: bool = False
+
 # メタデータをDBに保存する関数
-async def save_image_metadata(filename, public_url, analysis_result, user_id=None):
+async def save_image_metadata(filename, public_url, analysis_result, user_id=None, prompt_version=None,
+                              thumbnail_url=None, medium_url=None):
     """
     画像メタデータをSupabaseに保存する
     """
@@ -153,6 +290,16 @@ async def save_image_metadata(filename, public_url, analysis_result, user_id=Non
         
         if user_id:
             data["user_id"] = user_id
+        
+        # 使用したプロンプトのバージョン（変更時に再分析の対象を特定するため）
+        if prompt_version:
+            data["prompt_version"] = prompt_version
+        
+        # 履歴表示用の縮小画像のURL
+        if thumbnail_url:
+            data["thumbnail_url"] = thumbnail_url
+        if medium_url:
+            data["medium_url"] = medium_url
             
         print(f"🔵 準備したデータ:")
         for key, value in data.items():
@@ -205,6 +352,70 @@ async def save_image_metadata(filename, public_url, analysis_result, user_id=Non
                 "created_at": datetime.now().isoformat(), 
                 "error": str(e)}
 
+# Supabaseストレージの公開URL
+def storage_public_url(storage_path):
+    return f"{SUPABASE_URL}/storage/v1/object/public/meals/{storage_path}"
+
+# 公開URLからmealsバケット内のパスを求める
+def storage_path_from_url(image_url):
+    """
+    フロントエンドがアップロードした画像はバケット内のパスを返す
+    それ以外の外部URLは、同じURLが同じパスになるようハッシュから作る
+    """
+    prefix = storage_public_url("")
+    if SUPABASE_URL and image_url.startswith(prefix):
+        return unquote(image_url[len(prefix):].split("?")[0])
+    return f"external/{hashlib.sha256(image_url.encode('utf-8')).hexdigest()[:32]}"
+
+# Supabaseストレージへのアップロード
+def upload_to_storage(storage_path, data, content_type):
+    """
+    mealsバケットにファイルをアップロードする（成功した場合は True）
+    """
+    upload_url = f"{SUPABASE_URL}/storage/v1/object/meals/{storage_path}"
+    print(f"⭐️ ストレージアップロード: URL={upload_url} ({len(data) // 1024}KB)")
+    
+    upload_headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": content_type,
+        "x-upsert": "true"
+    }
+    
+    upload_response = requests.post(
+        upload_url, 
+        headers=upload_headers,
+        data=data,
+        timeout=30  # 大きいファイル用にタイムアウトを延長
+    )
+    
+    print(f"⭐️ アップロードレスポンス: {upload_response.status_code} ({storage_path})")
+    if upload_response.status_code not in [200, 201]:
+        print(f"❌ ファイルアップロードエラー: {upload_response.status_code} - {upload_response.text}")
+        return False
+    return True
+
+# 縮小画像を並列にアップロードする関数
+async def upload_renditions(original_path, renditions):
+    """
+    縮小画像（サムネイル・中サイズ）をオリジナルのパスに対応する位置へ並列にアップロードし、
+    save_image_metadata に渡せる {"thumbnail_url": ..., "medium_url": ...} を返す
+    """
+    names = list(renditions)
+    paths = [rendition_paths(original_path)[name] for name in names]
+    results = await asyncio.gather(
+        *[run_in_threadpool(upload_to_storage, path, renditions[name], "image/webp") for name, path in zip(names, paths)],
+        return_exceptions=True
+    )
+    
+    rendition_urls = {}
+    for name, path, result in zip(names, paths, results):
+        if isinstance(result, Exception):
+            print(f"❌ 縮小画像のアップロードでエラー ({name}): {result}")
+        elif result:
+            rendition_urls[f"{name}_url"] = storage_public_url(path)
+    return rendition_urls
+
 # 画像を分析する関数
 async def analyze_image(image_data, filename):
     """画像を分析してテキスト結果を返す"""
@@ -217,60 +428,24 @@ async def analyze_image(image_data, filename):
         return "テストモード: OpenAI APIキーがないため、この分析結果はダミーデータです。実際のカロリーや栄養成分は含まれていません。"
     
     try:
-        # 一時ディレクトリの作成（なければ）
-        os.makedirs("tmp", exist_ok=True)
-        temp_image_path = os.path.join("tmp", filename)
-        
-        # 画像データを一時ファイルに保存
-        print(f"🔵 画像データを一時ファイルに保存中: {temp_image_path}")
-        with open(temp_image_path, "wb") as f:
-            f.write(image_data)
-        
-        # Base64でエンコード
-        print(f"🔵 画像をBase64エンコード中...")
-        with open(temp_image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        
-        # OpenAI APIリクエスト用のプロンプト
-        system_prompt = """あなたは食事の画像を分析し、カロリーと栄養成分を推定する専門家です。
-以下の情報を日本語で提供してください:
-1. 写真に写っている食べ物の名前と説明
-2. 見た目から推定される大まかなカロリー
-3. 推定される主要な栄養成分（タンパク質、脂質、炭水化物）
-4. 健康的な視点からの簡単なコメント（200文字以内）
-
-数値はあくまで推定値であることを明記してください。
-専門用語は使わず、肯定的で優しい言葉遣いを心がけてください。「〜すべき」「〜しなければならない」という表現は避け、「〜すると良いかもしれません」「〜を試してみませんか？」のような提案型の言い方にしてください。"""
-                
+        # 高コストな処理の前に画像を検証
+        image_info = validate_image(image_data)
+    except ImageValidationError as e:
+        print(f"⚠️ 画像の検証に失敗: {e.message}")
+        return f"エラー: {e.message}"
+    
+    try:
         print(f"🔵 OpenAI APIリクエスト送信中...")
-        print(f"   - モデル: {OPENAI_MODEL if 'OPENAI_MODEL' in globals() else 'gpt-4o'}")
+        print(f"   - ルーティングポリシー: {model_router.policy} (上位モデル: {OPENAI_MODEL})")
         print(f"   - APIキー設定: {'あり' if openai_api_key else 'なし'}")
-        print(f"   - 画像データサイズ: {len(base64_image) // 1024}KB")
-        
-        # OpenAI APIを呼び出し
-        model = OPENAI_MODEL if 'OPENAI_MODEL' in globals() else "gpt-4o"
-        ai_response = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": "この食事の画像を分析してください。"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]}
-            ],
-            max_tokens=1000
-        )
+        print(f"   - 画像データサイズ: {len(image_data) // 1024}KB")
         
-        # 一時ファイルの削除
-        try:
-            os.remove(temp_image_path)
-            print(f"🔵 一時ファイルを削除しました: {temp_image_path}")
-        except Exception as e:
-            print(f"⚠️ 一時ファイル削除中にエラー: {e}")
+        # OpenAI APIを呼び出し（モデルはルーターが選択）
+        analysis = await run_in_threadpool(run_analysis, "nutrition", image_data, image_info.mime_type)
         
         # レスポンスからテキストを抽出
-        analysis_text = ai_response.choices[0].message.content
-        print(f"✅ 分析完了! 結果: {analysis_text[:100]}...")
+        analysis_text = analysis.text
+        print(f"✅ 分析完了 ({analysis.model}, {analysis.prompt_version})! 結果: {analysis_text[:100]}...")
         return analysis_text
         
     except Exception as e:
@@ -284,8 +459,35 @@ async def analyze_image(image_data, filename):
 async def root():
     return {"message": "Meal Checker API is working!"}
 
+@app.get("/admission")
+async def get_admission_stats():
+    """同時実行数・待ち行列の状況と、拒否したリクエスト数を返す"""
+    return admission_controller.stats()
+
+@app.get("/prompts")
+async def get_prompts():
+    """登録済みプロンプトのバージョンとトークン数を返す"""
+    return {"active": prompt_registry.active_versions(), "prompts": prompt_registry.describe()}
+
+@app.get("/model-routing")
+async def get_model_routing():
+    """現在のルーティングポリシーとモデル別のレイテンシ・トークン・コスト統計を返す"""
+    return model_router.stats()
+
+@app.put("/model-routing")
+async def update_model_routing(request: RoutingPolicyRequest, x_admin_token: Optional[str] = Header(None)):
+    """ルーティングポリシーを実行時に切り替える"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="管理トークンが無効です")
+    if request.policy not in ROUTING_POLICIES:
+        raise HTTPException(status_code=400, detail=f"未知のポリシーです。有効値: {', '.join(ROUTING_POLICIES)}")
+    model_router.set_policy(request.policy)
+    if request.reset_stats:
+        model_router.reset_stats()
+    return model_router.stats()
+
 @app.post("/analyze", response_model=dict)
-async def analyze_image(request: ImageUrlRequest):
+async def analyze_image(request: ImageUrlRequest, x_tier_token: Optional[str] = Header(None)):
     try:
         # リクエスト情報の詳細なログ出力
         print("="*50)
@@ -331,19 +533,26 @@ async def analyze_image(request: ImageUrlRequest):
             
             print(f"🔄 OpenAI APIを呼び出し中... image_url = {image_url}")
             
+            renditions_future = None
             try:
-                # 画像をダウンロードしてbase64エンコード
+                # 画像をダウンロードして検証
                 try:
                     print(f"📥 画像をダウンロード中: {image_url}")
-                    # 画像をダウンロード
-                    response = requests.get(image_url, timeout=10)
-                    response.raise_for_status()  # エラーチェック
+                    # 画像をダウンロード（上限を超える場合は途中で打ち切る）
+                    image_data = await run_in_threadpool(download_image, image_url, timeout=10)
                     
-                    # 画像データをBase64エンコード
-                    image_data = response.content
-                    base64_image = base64.b64encode(image_data).decode('utf-8')
+                    # 高コストな処理の前に画像を検証
+                    image_info = validate_image(image_data)
                     
-                    print(f"✅ 画像のダウンロードとエンコードに成功: サイズ = {len(image_data)} bytes")
+                    # 縮小画像の生成を分析と並行して開始
+                    renditions_future = start_renditions(image_data)
+                    
+                    print(f"✅ 画像のダウンロードに成功: サイズ = {len(image_data)} bytes")
+                except ImageValidationError as validation_error:
+                    print(f"⚠️ 画像の検証に失敗: {validation_error.message}")
+                    return {
+                        "comment": f"エラー: {validation_error.message}"
+                    }
                 except Exception as download_error:
                     print(f"❌ 画像のダウンロードに失敗: {str(download_error)}")
                     return {
@@ -354,54 +563,41 @@ async def analyze_image(request: ImageUrlRequest):
                 filename = image_url.split('/')[-1]
                 print(f"📝 抽出したファイル名: {filename}")
                 
-                # プロンプトを定義
-                prompt = """この食事写真を見て、親しみやすく前向きな口調で食事のバランスについてアドバイスしてください。相手を否定したり責めたりせず、励ましながら具体的なアドバイスを提供してください。
-
-以下の2点について、友達に話しかけるような温かみのある言葉で教えてあげてください：
-
-1. この食事の良い点と、続けるとどんな嬉しい変化が期待できるか：
-   （健康面でのメリットを前向きに伝えてください）
-
-2. もし良かったら試してみると嬉しい、小さな１つの提案：
-   （負担なく明日から試せる簡単なアイデアを1つだけ提案してください）
-
-専門用語は使わず、肯定的で優しい言葉遣いを心がけてください。「〜すべき」「〜しなければならない」という表現は避け、「〜すると良いかもしれません」「〜を試してみませんか？」のような提案型の言い方にしてください。"""
-                
-                # OpenAI APIを呼び出し
-                print("🤖 GPT-4o Vision APIを呼び出し中...")
-                ai_response = openai.chat.completions.create(
-                    model="gpt-4o",  # 最新のGPT-4モデル（Visionサポート付き）
-                    messages=[
-                        {
-                            "role": "user", 
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                            ]
-                        }
-                    ],
-                    max_tokens=300
+                # OpenAI APIを呼び出し（モデルはルーターが選択）
+                print(f"🤖 Vision APIを呼び出し中... (ポリシー: {model_router.policy})")
+                analysis = await run_in_threadpool(
+                    run_analysis, "advice", image_data, image_info.mime_type,
+                    user_tier=resolve_user_tier(x_tier_token)
                 )
                 
                 # 応答を取得
-                analysis_result = ai_response.choices[0].message.content
-                print(f"✅ GPT-4o分析結果: {analysis_result[:100]}...")
+                analysis_result = analysis.text
+                print(f"✅ {analysis.model}分析結果: {analysis_result[:100]}...")
+                
+                # 縮小画像をアップロード（オリジナルはフロントエンドがアップロード済み）
+                renditions = await collect_renditions(renditions_future)
+                rendition_urls = await upload_renditions(storage_path_from_url(image_url), renditions)
                 
                 # メタデータをDBに保存
                 print("💾 メタデータ保存処理開始...")
                 await save_image_metadata(
                     filename=filename,
                     public_url=image_url,
-                    analysis_result=analysis_result
+                    analysis_result=analysis_result,
+                    prompt_version=analysis.prompt_version,
+                    **rendition_urls
                 )
                 
-                return {"comment": analysis_result}
+                return {"comment": analysis_result, **rendition_urls}
                 
             except Exception as e:
                 print(f"❌ OpenAI API呼び出しエラー: {e}")
                 return {
                     "comment": f"エラー: OpenAI APIの呼び出しに失敗しました。{str(e)}"
                 }
+            finally:
+                # 分析に失敗した場合も、縮小画像の生成を放置しない
+                discard_renditions(renditions_future)
         except Exception as e:
             print(f"❌ エラーが発生しました: {e}")
             return {
@@ -414,7 +610,7 @@ async def analyze_image(request: ImageUrlRequest):
         } 
 
 @app.post("/analyze-direct", response_model=dict)
-async def analyze_direct(file: UploadFile = File(...)):
+async def analyze_direct(file: UploadFile = File(...), x_tier_token: Optional[str] = Header(None)):
     try:
         # OpenAI APIキーがない場合
         if not openai_api_key:
@@ -423,47 +619,30 @@ async def analyze_direct(file: UploadFile = File(...)):
             }
         
         try:
-            # 画像をbase64エンコードして直接OpenAI APIに送信
-            file_content = await file.read()
-            base64_image = base64.b64encode(file_content).decode('utf-8')
+            # 上限+1バイトまでだけ読み込み、高コストな処理の前に画像を検証
+            file_content = await file.read(MAX_IMAGE_BYTES + 1)
+            image_info = validate_image(file_content)
             
-            print(f"アップロードされた画像のエンコードに成功しました。サイズ: {len(file_content)} bytes")
+            print(f"アップロードされた画像を検証しました。サイズ: {len(file_content)} bytes")
+        except ImageValidationError as validation_error:
+            print(f"⚠️ 画像の検証に失敗: {validation_error.message}")
+            return {
+                "comment": f"エラー: {validation_error.message}"
+            }
         except Exception as encode_error:
             print(f"画像のエンコードに失敗しました: {str(encode_error)}")
             return {
                 "comment": f"エラー: 画像のエンコードに失敗しました。{str(encode_error)}"
             }
         
-        # プロンプトを定義
-        prompt = """この食事写真を見て、親しみやすく前向きな口調で食事のバランスについてアドバイスしてください。相手を否定したり責めたりせず、励ましながら具体的なアドバイスを提供してください。
-
-以下の2点について、友達に話しかけるような温かみのある言葉で教えてあげてください：
-
-1. この食事の良い点と、続けるとどんな嬉しい変化が期待できるか：
-   （健康面でのメリットを前向きに伝えてください）
-
-2. もし良かったら試してみると嬉しい、小さな１つの提案：
-   （負担なく明日から試せる簡単なアイデアを1つだけ提案してください）
-
-専門用語は使わず、肯定的で優しい言葉遣いを心がけてください。「〜すべき」「〜しなければならない」という表現は避け、「〜すると良いかもしれません」「〜を試してみませんか？」のような提案型の言い方にしてください。"""
-        
-        # OpenAI APIを呼び出してAI応答を取得
-        ai_response = openai.chat.completions.create(
-            model="gpt-4o",  # 最新のGPT-4モデル（Visionサポート付き）
-            messages=[
-                {
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                    ]
-                }
-            ],
-            max_tokens=300
+        # OpenAI APIを呼び出してAI応答を取得（モデルはルーターが選択）
+        analysis = await run_in_threadpool(
+            run_analysis, "advice", file_content, image_info.mime_type,
+            user_tier=resolve_user_tier(x_tier_token)
         )
         
         # 応答を取得
-        response_text = ai_response.choices[0].message.content
+        response_text = analysis.text
         
         # ファイル名をランダムに生成
         filename = f"{uuid.uuid4()}.jpg"
@@ -472,7 +651,8 @@ async def analyze_direct(file: UploadFile = File(...)):
         await save_image_metadata(
             filename=filename,
             public_url="direct-upload",  # 直接アップロードのため実際のURLはない
-            analysis_result=response_text
+            analysis_result=response_text,
+            prompt_version=analysis.prompt_version
         )
         
         return {"comment": response_text}
@@ -484,7 +664,7 @@ async def analyze_direct(file: UploadFile = File(...)):
         } 
 
 @app.post("/api/analyze")
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(file: UploadFile = File(...), x_tier_token: Optional[str] = Header(None)):
     """
     画像を分析するエンドポイント
     """
@@ -492,13 +672,27 @@ async def analyze_image(file: UploadFile = File(...)):
         print("\n" + "="*80)
         print(f"⭐️ analyze_image関数開始: ファイル名 {file.filename}")
         
-        # ファイルをバイナリとして読み込む
-        file_content = await file.read()
+        # ファイルをバイナリとして読み込む（上限+1バイトまで）
+        file_content = await file.read(MAX_IMAGE_BYTES + 1)
         print(f"⭐️ 画像を読み込みました: サイズ {len(file_content)} バイト")
+        
+        # 高コストな処理の前に画像を検証
+        try:
+            image_info = validate_image(file_content)
+        except ImageValidationError as validation_error:
+            print(f"⚠️ 画像の検証に失敗: {validation_error.message}")
+            return {
+                "error": True,
+                "message": validation_error.message,
+                "file": file.filename
+            }
+        print(f"⭐️ 画像を検証しました: {image_info.format} {image_info.width}x{image_info.height}")
 
-        # 一時ファイルに保存
+
+        # 一時ファイルに保存（クライアント由来のファイル名はサニタイズして使う）
         random_id = str(uuid.uuid4())
-        temp_file_name = f"temp_{random_id}_{file.filename}"
+        stored_name = safe_filename(file.filename, image_info.extension)
+        temp_file_name = f"temp_{random_id}{image_info.extension}"
         
         # 一時ディレクトリがなければ作成
         if not hasattr(app.config, 'temp_file_dir'):
@@ -514,54 +708,31 @@ async def analyze_image(file: UploadFile = File(...)):
         
         print(f"⭐️ 一時ファイルを保存しました: {file_path}")
         
+        # 縮小画像の生成を分析と並行して開始
+        renditions_future = start_renditions(file_content)
+        
         try:
             # 画像を分析
             print(f"⭐️ 画像分析を開始します...")
             
+            # 分析結果（テストデータの場合は None）
+            analysis = None
+            
             # OpenAI APIキーがない場合
             if not openai_api_key:
                 print("⚠️ OpenAI APIキーなし: テストデータを返します")
                 result = "これは美味しそうな食事ですね！バランスが良いと思います。"
             else:
-                # 画像をBase64エンコード
-                with open(file_path, "rb") as image_file:
-                    image_data = image_file.read()
-                    base64_image = base64.b64encode(image_data).decode('utf-8')
-                
-                print(f"✅ 画像をBase64エンコードしました: サイズ={len(image_data)}バイト")
-                
-                # プロンプトを定義
-                prompt = """この食事写真を見て、親しみやすく前向きな口調で食事のバランスについてアドバイスしてください。相手を否定したり責めたりせず、励ましながら具体的なアドバイスを提供してください。
-
-以下の2点について、友達に話しかけるような温かみのある言葉で教えてあげてください：
-
-1. この食事の良い点と、続けるとどんな嬉しい変化が期待できるか：
-   （健康面でのメリットを前向きに伝えてください）
-
-2. もし良かったら試してみると嬉しい、小さな１つの提案：
-   （負担なく明日から試せる簡単なアイデアを1つだけ提案してください）
-
-専門用語は使わず、肯定的で優しい言葉遣いを心がけてください。「〜すべき」「〜しなければならない」という表現は避け、「〜すると良いかもしれません」「〜を試してみませんか？」のような提案型の言い方にしてください。"""
-                
                 print("🤖 OpenAI APIリクエスト送信中...")
-                # OpenAI APIを呼び出し
-                ai_response = openai.chat.completions.create(
-                    model="gpt-4o",  # 最新のGPT-4モデル（Visionサポート付き）
-                    messages=[
-                        {
-                            "role": "user", 
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                            ]
-                        }
-                    ],
-                    max_tokens=300
+                # OpenAI APIを呼び出し（モデルはルーターが選択）
+                analysis = await run_in_threadpool(
+                    run_analysis, "advice", file_content, image_info.mime_type,
+                    user_tier=resolve_user_tier(x_tier_token)
                 )
                 
                 # 応答を取得
-                result = ai_response.choices[0].message.content
-                print(f"✅ OpenAI API応答受信: {len(result)}文字")
+                result = analysis.text
+                print(f"✅ OpenAI API応答受信 ({analysis.model}): {len(result)}文字")
             
             print(f"⭐️ 画像分析が完了しました")
             print(f"   - 分析結果: {result[:100]}...")
@@ -576,39 +747,29 @@ async def analyze_image(file: UploadFile = File(...)):
                     with open(file_path, "rb") as f:
                         file_data = f.read()
                     
-                    storage_path = f"meals/{random_id}_{file.filename}"
-                    upload_url = f"{SUPABASE_URL}/storage/v1/object/meals/public/{storage_path}"
+                    storage_path = f"meals/{random_id}_{stored_name}"
                     
-                    print(f"⭐️ ストレージアップロード: URL={upload_url}")
-                    
-                    upload_headers = {
-                        "apikey": SUPABASE_KEY,
-                        "Authorization": f"Bearer {SUPABASE_KEY}",
-                        "Content-Type": "application/octet-stream",
-                        "x-upsert": "true"
-                    }
-                    
-                    upload_response = requests.post(
-                        upload_url, 
-                        headers=upload_headers,
-                        data=file_data,
-                        timeout=30  # 大きいファイル用にタイムアウトを延長
+                    # オリジナルのアップロードを先に開始し、縮小画像の生成完了を待つ間も並行して進める
+                    # （オリジナルは失敗しても続行）
+                    original_upload = asyncio.create_task(
+                        run_in_threadpool(upload_to_storage, storage_path, file_data, image_info.mime_type)
+                    )
+                    renditions = await collect_renditions(renditions_future)
+                    _, rendition_urls = await asyncio.gather(
+                        original_upload,
+                        upload_renditions(storage_path, renditions)
                     )
-                    
-                    print(f"⭐️ アップロードレスポンス: {upload_response.status_code}")
-                    print(f"   - レスポンスデータ: {upload_response.text[:100]}")
-                    
-                    if upload_response.status_code not in [200, 201]:
-                        print(f"❌ ファイルアップロードエラー: {upload_response.status_code} - {upload_response.text}")
-                        # エラーがあっても続行
                     
                     # 公開URLを作成
-                    public_url = f"{SUPABASE_URL}/storage/v1/object/public/meals/{storage_path}"
+                    public_url = storage_public_url(storage_path)
                     print(f"⭐️ 公開URL: {public_url}")
                     
                     # メタデータをDBに保存
                     print(f"⭐️ メタデータの保存を開始...")
-                    metadata_result = await save_image_metadata(file.filename, public_url, result)
+                    # 結果を生成したプロンプトのバージョンを保存する（アクティブなバージョンを引き直さない）
+                    prompt_version = analysis.prompt_version if analysis else None
+                    metadata_result = await save_image_metadata(stored_name, public_url, result, prompt_version=prompt_version,
+                                                                **rendition_urls)
                     print(f"⭐️ メタデータ保存の結果: {metadata_result}")
                     
                 except Exception as upload_err:
@@ -625,6 +786,8 @@ async def analyze_image(file: UploadFile = File(...)):
                 metadata_result = {"id": "test-mode"}
             
         finally:
+            # 分析の失敗時やSupabase未接続時は、使わなかった縮小画像の生成を後始末する
+            discard_renditions(renditions_future)
             # 一時ファイルを削除
             if os.path.exists(file_path):
                 os.remove(file_path)
@@ -635,6 +798,7 @@ async def analyze_image(file: UploadFile = File(...)):
             "result": result,
             "file": file.filename,
             "public_url": public_url if 'public_url' in locals() else "未設定",
+            **(rendition_urls if 'rendition_urls' in locals() else {}),
             "metadata": metadata_result if 'metadata_result' in locals() else {"error": "メタデータ処理が完了していません"}
         }
     
@@ -0,0 +1,60 @@
+"""
+食事画像の分析処理（APIエンドポイントとバックフィルで共通）
+
+プロンプトの取得、メッセージの組み立て、モデルルーターの呼び出しと、
+プロンプトごとの出力トークン数・期待する見出しをここにまとめ、呼び出し元ごとに設定がずれないようにする。
+"""
+import base64
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence, Tuple
+
+from model_router import ModelRouter, model_router
+from prompt_registry import prompt_registry
+
+# プロンプトごとの設定: 名前 -> (max_tokens, 応答の信頼度判定に使う見出し)
+# 見出しが欠けていれば上位モデルへエスカレーションする
+ANALYSIS_SETTINGS = {
+    "advice": (300, ("1.", "2.")),
+    "nutrition": (1000, ("カロリー",)),
+}
+
+
+@dataclass
+class AnalysisResult:
+    """分析結果と、結果を生成したモデル・プロンプトのバージョン"""
+    text: str
+    model: str
+    prompt_version: str
+    escalated: bool = False
+
+
+def analysis_settings(prompt_name: str) -> Tuple[int, Sequence[str]]:
+    """プロンプトの (max_tokens, 期待する見出し) を返す"""
+    return ANALYSIS_SETTINGS[prompt_name]
+
+
+def run_analysis(prompt_name: str, image_data: bytes, mime_type: str, user_tier: Optional[str] = None,
+                 before_call: Optional[Callable[[], None]] = None,
+                 router: Optional[ModelRouter] = None) -> AnalysisResult:
+    """
+    検証済みの画像をプロンプトで分析する（ブロッキング。APIからは run_in_threadpool で呼ぶ）
+    before_call はOpenAI APIを呼び出す直前に毎回呼ばれる（バックフィルのレート制限用）
+    """
+    prompt = prompt_registry.get(prompt_name)
+    max_tokens, expected_markers = analysis_settings(prompt_name)
+    base64_image = base64.b64encode(image_data).decode("utf-8")
+
+    response = (router or model_router).complete(
+        messages=prompt.build_messages(base64_image, mime_type),
+        max_tokens=max_tokens,
+        image_size=len(image_data),
+        user_tier=user_tier,
+        expected_markers=expected_markers,
+        before_call=before_call
+    )
+    return AnalysisResult(
+        text=response.text,
+        model=response.model,
+        prompt_version=prompt.version_id,
+        escalated=response.escalated
+    )
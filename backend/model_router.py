@@ -0,0 +1,244 @@
+"""
+OpenAIモデルのルーティング（段階的推論）
+
+安価・高速なビジョンモデルを先に試し、必要な場合のみ上位モデル（gpt-4o）へ
+エスカレーションする。モデルごとのレイテンシ・トークン使用量・コストも記録する。
+"""
+import hmac
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional, Sequence
+
+# モデル設定（環境変数で上書き可能）
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")  # 上位モデル（エスカレーション先）
+OPENAI_FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", "gpt-4o-mini")  # 最初に試す安価なモデル
+
+# ルーティングポリシー
+#   fixed      : 常に上位モデルを使用（従来の動作）
+#   tiered     : 安価なモデルで実行し、信頼度が低い場合のみ上位モデルで再実行
+#   complexity : 画像サイズ（複雑さの目安）で使用モデルを選択
+#   user_tier  : ユーザー区分（premium など）で使用モデルを選択
+ROUTING_POLICIES = ("fixed", "tiered", "complexity", "user_tier")
+DEFAULT_POLICY = os.getenv("MODEL_ROUTING_POLICY", "tiered")
+
+# complexityポリシーで上位モデルを使う画像サイズの閾値（バイト）
+COMPLEXITY_THRESHOLD_BYTES = int(os.getenv("MODEL_COMPLEXITY_THRESHOLD_BYTES", str(1_500_000)))
+
+# user_tierポリシーで上位モデルを使うユーザー区分
+PREMIUM_TIERS = {"premium", "pro"}
+
+# サーバー側で発行した区分トークン: "トークン:区分,トークン:区分"
+# （クライアントが自己申告した区分は信用せず、このトークンで確認できた場合のみ区分を認める）
+USER_TIER_TOKENS = dict(
+    entry.split(":", 1) for entry in os.getenv("USER_TIER_TOKENS", "").split(",") if ":" in entry
+)
+
+# max_tokensで打ち切られた応答をエスカレーションする際の出力トークン数の倍率
+ESCALATION_TOKEN_MULTIPLIER = float(os.getenv("ESCALATION_TOKEN_MULTIPLIER", "2"))
+
+# 100万トークンあたりの料金（USD）: (入力, 出力)
+MODEL_PRICING = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+
+# 応答がこれより短い場合は信頼度が低いとみなす（文字数）
+MIN_CONFIDENT_LENGTH = 40
+
+
+@dataclass
+class ModelStats:
+    """モデルごとの累積統計"""
+    calls: int = 0
+    errors: int = 0
+    escalations: int = 0
+    total_latency_ms: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "escalations": self.escalations,
+            "avg_latency_ms": round(self.total_latency_ms / self.calls, 1) if self.calls else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+        }
+
+
+@dataclass
+class RoutedResult:
+    """ルーティング結果"""
+    text: str
+    model: str
+    escalated: bool = False
+    attempts: List[str] = field(default_factory=list)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """トークン数から料金（USD）を見積もる"""
+    input_price, output_price = MODEL_PRICING.get(model, MODEL_PRICING["gpt-4o"])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def resolve_user_tier(tier_token: Optional[str]) -> Optional[str]:
+    """区分トークンをサーバー側の設定と照合し、確認できた区分を返す（不明な場合は None）"""
+    if not tier_token:
+        return None
+    for token, tier in USER_TIER_TOKENS.items():
+        if hmac.compare_digest(token.strip(), tier_token):
+            return tier.strip().lower()
+    return None
+
+
+def is_low_confidence(text: Optional[str], finish_reason: Optional[str],
+                      expected_markers: Sequence[str] = ()) -> bool:
+    """
+    応答の信頼度が低いかを判定する
+    - 空・極端に短い応答
+    - max_tokensで打ち切られた応答
+    - 期待する構造（「1.」「2.」などの見出し）が欠けている応答
+    """
+    if not text or len(text.strip()) < MIN_CONFIDENT_LENGTH:
+        return True
+    if finish_reason == "length":
+        return True
+    return any(marker not in text for marker in expected_markers)
+
+
+class ModelRouter:
+    """ポリシーに従ってモデルを選択し、OpenAI APIを呼び出す"""
+
+    def __init__(self, policy: str = DEFAULT_POLICY, fast_model: str = OPENAI_FAST_MODEL,
+                 strong_model: str = OPENAI_MODEL):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self._lock = threading.Lock()
+        self._stats: Dict[str, ModelStats] = {}
+        self.policy = "fixed"
+        self.set_policy(policy)
+
+    def set_policy(self, policy: str) -> None:
+        """ルーティングポリシーを実行時に切り替える"""
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"未知のルーティングポリシー: {policy} (有効値: {', '.join(ROUTING_POLICIES)})")
+        self.policy = policy
+        print(f"🔀 モデルルーティングポリシー: {policy} (fast={self.fast_model}, strong={self.strong_model})")
+
+    def choose_model(self, image_size: int = 0, user_tier: Optional[str] = None) -> str:
+        """最初に使用するモデルを選択する"""
+        if self.policy == "fixed":
+            return self.strong_model
+        if self.policy == "complexity":
+            return self.strong_model if image_size >= COMPLEXITY_THRESHOLD_BYTES else self.fast_model
+        if self.policy == "user_tier":
+            return self.strong_model if (user_tier or "").lower() in PREMIUM_TIERS else self.fast_model
+        return self.fast_model
+
+    def complete(self, messages: List[Dict[str, Any]], max_tokens: int, image_size: int = 0,
+                 user_tier: Optional[str] = None, expected_markers: Sequence[str] = (),
+                 before_call: Optional[Callable[[], None]] = None) -> RoutedResult:
+        """
+        選択したモデルで補完を実行し、信頼度が低ければ上位モデルへエスカレーションする
+        - 安価なモデルの呼び出しが失敗した場合（429・未知のモデルなど）も上位モデルで再実行する
+        - 打ち切られた応答の再実行では、同じ長さで再び打ち切られないよう max_tokens を増やす
+        user_tier は resolve_user_tier で確認済みの区分を渡すこと
+        before_call はAPI呼び出しの直前に毎回（エスカレーション時は2回）呼ばれる（レート制限用）
+        """
+        before_call = before_call or (lambda: None)
+        model = self.choose_model(image_size=image_size, user_tier=user_tier)
+        attempts = [model]
+        before_call()
+        try:
+            text, finish_reason = self._call(model, messages, max_tokens)
+        except Exception as e:
+            if model == self.strong_model:
+                raise
+            print(f"⤴️ {model} の呼び出しに失敗したため {self.strong_model} で再実行します: {e}")
+            text, finish_reason = None, "error"
+
+        if model != self.strong_model and is_low_confidence(text, finish_reason, expected_markers):
+            if finish_reason != "error":
+                print(f"⤴️ 信頼度が低いため {model} → {self.strong_model} にエスカレーションします")
+            with self._lock:
+                self._stats_for(model).escalations += 1
+            if finish_reason == "length":
+                max_tokens = int(max_tokens * ESCALATION_TOKEN_MULTIPLIER)
+            model = self.strong_model
+            attempts.append(model)
+            before_call()
+            text, _ = self._call(model, messages, max_tokens)
+
+        return RoutedResult(text=text, model=model, escalated=len(attempts) > 1, attempts=attempts)
+
+    def stats(self) -> Dict[str, Any]:
+        """現在のポリシーとモデル別統計を返す"""
+        with self._lock:
+            per_model = {name: s.to_dict() for name, s in self._stats.items()}
+        return {
+            "policy": self.policy,
+            "fast_model": self.fast_model,
+            "strong_model": self.strong_model,
+            "models": per_model,
+            "total_cost_usd": round(sum(m["cost_usd"] for m in per_model.values()), 6),
+        }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def warm_up(self) -> None:
+        """OpenAI SDKを読み込んでおく（起動時はバックグラウンドで呼ぶ）"""
+        import openai  # noqa: F401
+
+    def _stats_for(self, model: str) -> ModelStats:
+        return self._stats.setdefault(model, ModelStats())
+
+    def _call(self, model: str, messages: List[Dict[str, Any]], max_tokens: int):
+        """OpenAI APIを1回呼び出し、統計を記録する"""
+        import openai  # 起動を速くするため初回利用時に読み込む
+
+        start = time.perf_counter()
+        try:
+            response = openai.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens
+            )
+        except Exception:
+            with self._lock:
+                stats = self._stats_for(model)
+                stats.calls += 1
+                stats.errors += 1
+                stats.total_latency_ms += (time.perf_counter() - start) * 1000
+            raise
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+
+        with self._lock:
+            stats = self._stats_for(model)
+            stats.calls += 1
+            stats.total_latency_ms += latency_ms
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.cost_usd += cost
+
+        choice = response.choices[0]
+        print(f"🤖 {model}: {latency_ms:.0f}ms, tokens={prompt_tokens}+{completion_tokens}, cost=${cost:.5f}")
+        return choice.message.content, getattr(choice, "finish_reason", None)
+
+
+# アプリ全体で共有するルーター
+model_router = ModelRouter()
@@ -0,0 +1,155 @@
+"""
+プロンプトレジストリ
+
+prompts/<名前>/<バージョン>.txt を起動時に一度だけ読み込み、静的なメッセージ部分を
+事前に組み立てておく。リクエストごとに付け足すのは画像だけなので、静的なプレフィックスは毎回同一になる。
+ただしOpenAIのプロンプトキャッシュは1024トークン以上のプロンプトにしか効かないため、
+現在のプロンプト（数百トークン）ではキャッシュは効かない。
+"""
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
+
+PROMPTS_DIR = os.path.join(os.path.dirname(__file__), "prompts")
+
+# 画像の前に置く固定のユーザー指示（プロンプトごと）
+USER_INSTRUCTIONS = {
+    "nutrition": "この食事の画像を分析してください。",
+}
+
+# トークン数の計算に使うエンコーディング（gpt-4o系）
+TOKENIZER_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    tiktokenのエンコーディングを初回利用時に読み込む
+    （起動を遅らせないため。コンテナでは TIKTOKEN_CACHE_DIR に事前取得しておく）
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:  # tiktokenが未インストール、またはエンコーディングを取得できない場合
+        return None
+
+
+@lru_cache(maxsize=64)
+def count_tokens(text: str) -> int:
+    """
+    テキストのトークン数をオフラインで数える
+    tiktokenがない場合は文字数ベースの概算（日本語はおおよそ1文字1トークン）
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text)
+
+
+def _version_key(version: str):
+    """v1, v2, v10 を数値順に並べるためのキー"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", version)]
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """バージョン付きプロンプトと、事前に組み立てた静的メッセージ"""
+    name: str
+    version: str
+    text: str
+    prefix_messages: tuple
+
+    @property
+    def token_count(self) -> int:
+        return count_tokens(self.text)
+
+    @property
+    def version_id(self) -> str:
+        """meal_images.prompt_version に保存する識別子（例: advice@v1）"""
+        return f"{self.name}@{self.version}"
+
+    def build_messages(self, base64_image: str, mime_type: str = "image/jpeg") -> List[Dict[str, Any]]:
+        """静的プレフィックスの後ろに画像を付け足してメッセージを作る"""
+        user_content = []
+        instruction = USER_INSTRUCTIONS.get(self.name)
+        if instruction:
+            user_content.append({"type": "text", "text": instruction})
+        user_content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}})
+        return [*self.prefix_messages, {"role": "user", "content": user_content}]
+
+
+class PromptRegistry:
+    """起動時にプロンプトを読み込んで保持する"""
+
+    def __init__(self, prompts_dir: str = PROMPTS_DIR):
+        self.prompts_dir = prompts_dir
+        self._templates: Dict[str, Dict[str, PromptTemplate]] = {}
+        self._active: Dict[str, str] = {}
+        self.load()
+
+    def load(self) -> None:
+        """プロンプトファイルを読み込み、アクティブなバージョンを決定する"""
+        templates: Dict[str, Dict[str, PromptTemplate]] = {}
+        for name in sorted(os.listdir(self.prompts_dir)):
+            prompt_dir = os.path.join(self.prompts_dir, name)
+            if not os.path.isdir(prompt_dir):
+                continue
+            for filename in sorted(os.listdir(prompt_dir)):
+                if not filename.endswith(".txt"):
+                    continue
+                version = filename[:-len(".txt")]
+                with open(os.path.join(prompt_dir, filename), encoding="utf-8") as f:
+                    text = f.read().strip()
+                prefix = ({"role": "system", "content": text},)
+                templates.setdefault(name, {})[version] = PromptTemplate(
+                    name=name,
+                    version=version,
+                    text=text,
+                    prefix_messages=prefix
+                )
+
+        active = {}
+        for name, versions in templates.items():
+            # 環境変数 PROMPT_<NAME>_VERSION で固定できる（未指定なら最新バージョン）
+            pinned = os.getenv(f"PROMPT_{name.upper()}_VERSION")
+            if pinned and pinned not in versions:
+                raise ValueError(f"プロンプト {name} にバージョン {pinned} がありません")
+            active[name] = pinned or max(versions, key=_version_key)
+
+        self._templates = templates
+        self._active = active
+        for name, version in active.items():
+            print(f"📝 プロンプト読み込み: {templates[name][version].version_id}")
+
+    def get(self, name: str, version: Optional[str] = None) -> PromptTemplate:
+        """プロンプトを取得する（バージョン省略時はアクティブなバージョン）"""
+        if name not in self._templates:
+            raise KeyError(f"未登録のプロンプト: {name}")
+        return self._templates[name][version or self._active[name]]
+
+    def warm_up(self) -> None:
+        """トークナイザーを読み込み、アクティブなプロンプトのトークン数を計算しておく"""
+        for name in self._active:
+            template = self.get(name)
+            print(f"📝 {template.version_id}: {template.token_count} tokens")
+
+    def active_versions(self) -> Dict[str, str]:
+        return {name: self.get(name).version_id for name in self._active}
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """登録済みプロンプトの一覧（トークン数付き）"""
+        return [
+            {
+                "id": template.version_id,
+                "active": self._active[name] == version,
+                "token_count": template.token_count,
+            }
+            for name, versions in self._templates.items()
+            for version, template in sorted(versions.items(), key=lambda item: _version_key(item[0]))
+        ]
+
+
+# アプリ全体で共有するレジストリ
+prompt_registry = PromptRegistry()
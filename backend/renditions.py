@@ -0,0 +1,100 @@
+"""
+履歴表示用の縮小画像（サムネイル・中サイズのWebP）の生成
+
+オリジナル画像（数MB）の代わりに一覧表示で使う軽量な画像を作る。
+デコード・縮小・エンコードはPillowがGILを解放して行うため、専用のスレッドプールで
+OpenAI APIの呼び出しと並行して実行する。
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional
+
+from image_validation import MAX_IMAGE_PIXELS
+
+# 生成するサイズ: 名前 -> 長辺のピクセル数（大きい順）
+RENDITION_SIZES = {
+    "medium": 1280,
+    "thumbnail": 320,
+}
+WEBP_QUALITY = int(os.getenv("RENDITION_WEBP_QUALITY", "80"))
+RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", "2"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=RENDITION_WORKERS, thread_name_prefix="rendition")
+    return _executor
+
+
+def render_renditions(image_data: bytes) -> Dict[str, bytes]:
+    """
+    画像を一度だけデコードし、各サイズのWebPを生成する
+    Pillowがない場合は空の辞書を返す（オリジナルのみ保存される）
+    """
+    try:
+        from PIL import Image, ImageOps  # 起動を速くするため初回利用時に読み込む
+    except ImportError:
+        print("⚠️ Pillowがインストールされていないため、縮小画像は生成しません")
+        return {}
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    largest = max(RENDITION_SIZES.values())
+    renditions = {}
+    with Image.open(BytesIO(image_data)) as source:
+        # JPEGは縮小した解像度で直接デコードして、デコード時間とメモリを抑える
+        source.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+        # 大きいサイズから順に縮小し、前のサイズを次の縮小元にする
+        for name, max_side in RENDITION_SIZES.items():
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            buffer = BytesIO()
+            image.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=4)
+            renditions[name] = buffer.getvalue()
+    return renditions
+
+
+def rendition_paths(original_path: str) -> Dict[str, str]:
+    """
+    オリジナルのストレージパスから縮小画像のパスを決める（名前 -> パス）
+    どのエンドポイントから保存しても、renditions/<オリジナルのパス（拡張子なし）>_<名前>.webp に揃える
+    """
+    stem = os.path.splitext(original_path)[0]
+    return {name: f"renditions/{stem}_{name}.webp" for name in RENDITION_SIZES}
+
+
+def start_renditions(image_data: bytes) -> "asyncio.Future[Dict[str, bytes]]":
+    """縮小画像の生成をスレッドプールで開始する（結果は後で await する）"""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(_get_executor(), render_renditions, image_data)
+
+
+async def collect_renditions(future: "asyncio.Future[Dict[str, bytes]]") -> Dict[str, bytes]:
+    """生成結果を受け取る（失敗してもオリジナルの保存は続けられるよう空の辞書を返す）"""
+    try:
+        renditions = await future
+    except Exception as e:
+        print(f"❌ 縮小画像の生成に失敗: {e}")
+        return {}
+    sizes = ", ".join(f"{name}={len(data) // 1024}KB" for name, data in renditions.items())
+    print(f"🖼️ 縮小画像を生成しました: {sizes}")
+    return renditions
+
+
+def discard_renditions(future: "Optional[asyncio.Future[Dict[str, bytes]]]") -> None:
+    """
+    受け取らなかった生成処理を後始末する（分析の失敗時などに finally で呼ぶ）
+    未開始ならキャンセルし、完了済みなら例外を取り出して未取得の警告を出さないようにする
+    """
+    if future is None:
+        return
+    if not future.done():
+        future.cancel()
+    elif not future.cancelled():
+        future.exception()
@@ -0,0 +1,304 @@
+"""
+admission のテスト（レート制限は時刻を引数で渡して検証する）
+
+使い方:
+    python -m pytest test_admission.py
+"""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from admission import (
+    AdmissionController, AdmissionRejected, FairScheduler, SlidingWindowLimiter, client_ip_from
+)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def settle():
+    """待機中のタスクを一巡させる"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+# --- SlidingWindowLimiter ---
+
+def test_limiter_allows_up_to_limit_then_rejects():
+    limiter = SlidingWindowLimiter(limit=3, window=60)
+    assert [limiter.hit("a", now=t) for t in (0, 1, 2)] == [None, None, None]
+    assert limiter.hit("a", now=3) == pytest.approx(57)
+
+
+def test_limiter_window_slides():
+    limiter = SlidingWindowLimiter(limit=2, window=10)
+    limiter.hit("a", now=0)
+    limiter.hit("a", now=5)
+    assert limiter.hit("a", now=9.9) == pytest.approx(0.1)
+    # 最も古い記録が窓から外れた時点で再び受け付ける
+    assert limiter.hit("a", now=10) is None
+    assert limiter.hit("a", now=11) == pytest.approx(4)
+
+
+def test_limiter_rejected_hits_are_not_recorded():
+    limiter = SlidingWindowLimiter(limit=1, window=10)
+    limiter.hit("a", now=0)
+    for t in range(1, 10):
+        assert limiter.hit("a", now=t) is not None
+    # 拒否されたリクエストで窓が延長されない
+    assert limiter.hit("a", now=10) is None
+
+
+def test_limiter_keys_are_independent():
+    limiter = SlidingWindowLimiter(limit=1, window=60)
+    assert limiter.hit("a", now=0) is None
+    assert limiter.hit("b", now=0) is None
+    assert limiter.hit("a", now=1) is not None
+
+
+def test_limiter_prunes_expired_keys(monkeypatch):
+    monkeypatch.setattr("admission._PRUNE_THRESHOLD", 3)
+    limiter = SlidingWindowLimiter(limit=1, window=10)
+    for i in range(3):
+        limiter.hit(f"old{i}", now=0)
+    limiter.hit("new", now=20)
+    assert list(limiter._hits) == ["new"]
+
+
+# --- FairScheduler ---
+
+def test_scheduler_admits_immediately_under_cap():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=2, max_queue=2)
+        await scheduler.acquire("a", timeout=1)
+        await scheduler.acquire("a", timeout=1)
+        assert (scheduler.in_flight, scheduler.waiting) == (2, 0)
+        scheduler.release()
+        scheduler.release()
+        assert (scheduler.in_flight, scheduler.waiting) == (0, 0)
+    run(scenario())
+
+
+def test_scheduler_hands_off_slot_to_waiter():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=4)
+        await scheduler.acquire("a", timeout=1)
+        waiter = asyncio.create_task(scheduler.acquire("b", timeout=1))
+        await settle()
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 1)
+
+        scheduler.release()
+        await waiter
+        # 枠はそのまま引き渡されるので in_flight は変わらない
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 0)
+        scheduler.release()
+        assert scheduler.in_flight == 0
+    run(scenario())
+
+
+def test_scheduler_round_robins_between_keys():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=8)
+        await scheduler.acquire("busy", timeout=1)
+        order = []
+
+        async def request(key, n):
+            await scheduler.acquire(key, timeout=5)
+            order.append(f"{key}{n}")
+
+        # a が3件先に並んでも、b の1件は a の2件目より先に処理される
+        tasks = [asyncio.create_task(request("a", n)) for n in range(3)]
+        await settle()
+        tasks.append(asyncio.create_task(request("b", 0)))
+        await settle()
+
+        for _ in range(4):
+            scheduler.release()
+            await settle()
+        await asyncio.gather(*tasks)
+        assert order == ["a0", "b0", "a1", "a2"]
+    run(scenario())
+
+
+def test_scheduler_rejects_when_queue_is_full():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=1)
+        await scheduler.acquire("a", timeout=1)
+        waiter = asyncio.create_task(scheduler.acquire("b", timeout=1))
+        await settle()
+        with pytest.raises(AdmissionRejected) as e:
+            await scheduler.acquire("c", timeout=1)
+        assert e.value.status_code == 503
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+    run(scenario())
+
+
+def test_scheduler_waiter_times_out_and_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=2)
+        await scheduler.acquire("a", timeout=1)
+        with pytest.raises(AdmissionRejected) as e:
+            await scheduler.acquire("b", timeout=0.01)
+        assert e.value.status_code == 503
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 0)
+        assert not scheduler._queues
+        # 待ち時間切れのリクエストに枠が渡されず、解放すると空きに戻る
+        scheduler.release()
+        assert scheduler.in_flight == 0
+    run(scenario())
+
+
+def test_scheduler_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=4)
+        await scheduler.acquire("a", timeout=1)
+        cancelled = asyncio.create_task(scheduler.acquire("b", timeout=5))
+        survivor = asyncio.create_task(scheduler.acquire("c", timeout=5))
+        await settle()
+
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert scheduler.waiting == 1
+
+        # 切断したリクエストは飛ばして次の待ちに枠を渡す
+        scheduler.release()
+        await survivor
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 0)
+    run(scenario())
+
+
+def test_scheduler_cancel_after_handoff_returns_slot():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_queue=4)
+        await scheduler.acquire("a", timeout=1)
+        first = asyncio.create_task(scheduler.acquire("b", timeout=5))
+        second = asyncio.create_task(scheduler.acquire("c", timeout=5))
+        await settle()
+
+        # 枠を受け取った直後（再開する前）に切断された場合、枠は次の待ちへ渡る
+        scheduler.release()
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await second
+        assert (scheduler.in_flight, scheduler.waiting) == (1, 0)
+        scheduler.release()
+        assert scheduler.in_flight == 0
+    run(scenario())
+
+
+# --- AdmissionController ---
+
+def test_controller_rate_limits_by_ip():
+    async def scenario():
+        controller = AdmissionController()
+        controller.ip_limiter = SlidingWindowLimiter(limit=2, window=30)
+        for _ in range(2):
+            await controller.admit("203.0.113.9")
+            controller.release()
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.admit("203.0.113.9")
+        assert e.value.status_code == 429
+        assert 1 <= e.value.retry_after <= 30
+        assert controller.stats()["rejected_429"] == 1
+        await controller.admit("198.51.100.1")
+        controller.release()
+    run(scenario())
+
+
+def test_controller_keys_queue_on_client_ip():
+    async def scenario():
+        controller = AdmissionController()
+        controller.scheduler = FairScheduler(max_in_flight=1, max_queue=4)
+        await controller.admit("203.0.113.9")
+        waiter = asyncio.create_task(controller.admit("198.51.100.1"))
+        await settle()
+        assert list(controller.scheduler._queues) == ["198.51.100.1"]
+        controller.release()
+        await waiter
+        controller.release()
+    run(scenario())
+
+
+# --- client_ip_from ---
+
+@pytest.mark.parametrize("forwarded, hops, expected", [
+    ("203.0.113.9", 1, "203.0.113.9"),
+    # クライアントが先頭に書いた値ではなく、プロキシが末尾に追加した値を使う
+    ("1.2.3.4, 203.0.113.9", 1, "203.0.113.9"),
+    ("1.2.3.4,5.6.7.8, 203.0.113.9", 1, "203.0.113.9"),
+    # ロードバランサ経由（クライアントIP, LBのIP）
+    ("1.2.3.4, 203.0.113.9, 35.191.0.1", 2, "203.0.113.9"),
+    ("203.0.113.9", 2, "203.0.113.9"),
+    (" , ", 1, "10.0.0.1"),
+])
+def test_client_ip_from_forwarded_for(forwarded, hops, expected):
+    headers = {"x-forwarded-for": forwarded}
+    assert client_ip_from(headers, "10.0.0.1", trust_forwarded_for=True, trusted_hops=hops) == expected
+
+
+def test_client_ip_from_ignores_header_unless_trusted():
+    headers = {"x-forwarded-for": "1.2.3.4"}
+    assert client_ip_from(headers, "10.0.0.1", trust_forwarded_for=False) == "10.0.0.1"
+    assert client_ip_from({}, None, trust_forwarded_for=True) == "unknown"
+
+
+# --- ミドルウェア（TestClient 経由） ---
+
+@pytest.fixture
+def client(monkeypatch):
+    import main
+    monkeypatch.setattr(main, "admission_controller", AdmissionController())
+    return TestClient(main.app), main.admission_controller
+
+
+def chunked_multipart(total_bytes, chunk_size=1024 * 1024):
+    """Content-Length を付けずに送る multipart 本文"""
+    yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="a.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'
+    for _ in range(total_bytes // chunk_size):
+        yield b"\xff" * chunk_size
+    yield b"\r\n--b--\r\n"
+
+
+def test_middleware_rejects_chunked_upload_over_limit_with_413(client):
+    test_client, controller = client
+    response = test_client.post("/api/analyze", content=chunked_multipart(30 * 1024 * 1024),
+                                headers={"content-type": "multipart/form-data; boundary=b"})
+    assert response.status_code == 413
+    assert response.json()["error"] is True
+    # 実行枠は解放されている
+    assert controller.stats()["in_flight"] == 0
+
+
+def test_middleware_rejects_oversized_content_length_before_queueing(client):
+    test_client, controller = client
+    controller.scheduler.in_flight = controller.scheduler.max_in_flight
+    response = test_client.post("/api/analyze", content=b"x",
+                                headers={"content-type": "multipart/form-data; boundary=b",
+                                         "content-length": "999999999"})
+    assert response.status_code == 413
+    assert response.json()["error"] is True
+    # 待ち行列にも並ばず、レート制限の回数も消費しない
+    assert controller.stats()["waiting"] == 0
+    assert controller.stats()["rejected_503"] == 0
+    assert not controller.ip_limiter._hits
+
+
+def test_middleware_returns_429_with_retry_after(client):
+    test_client, controller = client
+    controller.ip_limiter = SlidingWindowLimiter(limit=1, window=60)
+    controller.ip_limiter.hit("testclient")
+    response = test_client.post("/analyze", json={"image_url": "not-a-url"})
+    assert response.status_code == 429
+    assert response.json()["error"] is True
+    assert 1 <= int(response.headers["retry-after"]) <= 60
+
+
+def test_middleware_ignores_other_paths(client):
+    test_client, controller = client
+    controller.ip_limiter = SlidingWindowLimiter(limit=0, window=60)
+    assert test_client.get("/").status_code == 200
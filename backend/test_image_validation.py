@@ -0,0 +1,334 @@
+"""
+image_validation とアップロードサイズ制限のテスト
+- 画像のヘッダーは手で組み立てて検証する
+- サイズ制限のミドルウェアは TestClient 経由で検証する
+
+使い方:
+    python -m pytest test_image_validation.py
+"""
+import asyncio
+import struct
+from io import BytesIO
+
+import pytest
+from fastapi.testclient import TestClient
+
+from image_validation import (
+    MAX_IMAGE_BYTES, MAX_IMAGE_PIXELS, MAX_IMAGE_SIDE, MULTIPART_OVERHEAD_BYTES, ImageValidationError,
+    check_content_length, read_dimensions, safe_filename, sniff_format, validate_image
+)
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    """JPEGのセグメント（マーカー + 長さ + 本体）"""
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _sof(width: int, height: int, marker: int = 0xC0) -> bytes:
+    return _segment(marker, b"\x08" + struct.pack(">HH", height, width) + b"\x03" + b"\x00" * 9)
+
+
+def make_jpeg(width: int, height: int, marker: int = 0xC0, before_sof: bytes = b"") -> bytes:
+    app0 = _segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+    return b"\xff\xd8" + app0 + before_sof + _sof(width, height, marker) + b"\xff\xd9"
+
+
+def make_png(width: int, height: int) -> bytes:
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height) + b"\x08\x02\x00\x00\x00"
+
+
+def make_gif(width: int, height: int) -> bytes:
+    return b"GIF89a" + struct.pack("<HH", width, height) + b"\x00\x00\x00"
+
+
+def _riff(chunk: bytes, payload: bytes) -> bytes:
+    body = b"WEBP" + chunk + struct.pack("<I", len(payload)) + payload
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def make_webp_vp8(width: int, height: int, scale_bits: int = 0) -> bytes:
+    # フレームタグ(3) + 開始コード(3) + 幅・高さ（上位2ビットはスケール）
+    payload = b"\x00\x00\x00" + b"\x9d\x01\x2a" + struct.pack("<HH", width | scale_bits << 14, height | scale_bits << 14)
+    return _riff(b"VP8 ", payload)
+
+
+def make_webp_vp8l(width: int, height: int) -> bytes:
+    # シグネチャ 0x2F + 14ビットずつの (幅-1)・(高さ-1)
+    bits = (width - 1) | (height - 1) << 14
+    return _riff(b"VP8L", b"\x2f" + bits.to_bytes(4, "little"))
+
+
+def make_webp_vp8x(width: int, height: int) -> bytes:
+    # フラグ(1) + 予約(3) + 24ビットずつの (幅-1)・(高さ-1)
+    payload = b"\x00" * 4 + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+    return _riff(b"VP8X", payload)
+
+
+# --- 形式判定 ---
+
+@pytest.mark.parametrize("data, expected", [
+    (make_jpeg(1, 1), "jpeg"),
+    (make_png(1, 1), "png"),
+    (make_gif(1, 1), "gif"),
+    (make_webp_vp8(1, 1), "webp"),
+    (b"GIF87a" + b"\x00" * 8, "gif"),
+    (b"%PDF-1.7", None),
+    (b"RIFF\x00\x00\x00\x00WAVE", None),
+    (b"", None),
+])
+def test_sniff_format(data, expected):
+    assert sniff_format(data) == expected
+
+
+# --- JPEGのマーカー走査 ---
+
+def test_jpeg_size_after_app_segments():
+    assert read_dimensions(make_jpeg(640, 480), "jpeg") == (640, 480)
+
+
+@pytest.mark.parametrize("marker", [0xC0, 0xC1, 0xC2, 0xCF])
+def test_jpeg_sof_variants(marker):
+    assert read_dimensions(make_jpeg(800, 600, marker=marker), "jpeg") == (800, 600)
+
+
+@pytest.mark.parametrize("marker", [0xC4, 0xC8, 0xCC])
+def test_jpeg_dht_jpg_dac_are_not_sof(marker):
+    # DHT/JPG/DAC は寸法を持たないので読み飛ばし、後ろの SOF を使う
+    data = make_jpeg(320, 240, before_sof=_segment(marker, b"\x00" * 20))
+    assert read_dimensions(data, "jpeg") == (320, 240)
+
+
+def test_jpeg_skips_fill_bytes_and_standalone_markers():
+    data = make_jpeg(100, 50, before_sof=b"\xff\xff\xff" + b"\xff\xd0" + b"\xff\x01")
+    assert read_dimensions(data, "jpeg") == (100, 50)
+
+
+def test_jpeg_sos_before_sof_has_no_size():
+    data = b"\xff\xd8" + _segment(0xDA, b"\x00" * 10) + _sof(100, 100)
+    assert read_dimensions(data, "jpeg") is None
+
+
+def test_jpeg_garbage_between_segments():
+    data = b"\xff\xd8" + _segment(0xE0, b"\x00" * 4) + b"\x00\x00" + _sof(100, 100)
+    assert read_dimensions(data, "jpeg") is None
+
+
+@pytest.mark.parametrize("cut", [3, 4, 5, 25, -8, -2])
+def test_jpeg_truncated_header(cut):
+    data = make_jpeg(640, 480)
+    sof_end = data.index(b"\xff\xc0") + 9
+    truncated = data[:cut] if cut > 0 else data[:sof_end + cut]
+    assert read_dimensions(truncated, "jpeg") is None
+
+
+def test_jpeg_matches_pillow():
+    Image = pytest.importorskip("PIL.Image")
+    buffer = BytesIO()
+    Image.new("RGB", (123, 45)).save(buffer, format="JPEG", progressive=True)
+    assert read_dimensions(buffer.getvalue(), "jpeg") == (123, 45)
+
+
+# --- WebPのビットフィールド ---
+
+def test_webp_vp8_masks_scale_bits():
+    assert read_dimensions(make_webp_vp8(16383, 2, scale_bits=3), "webp") == (16383, 2)
+
+
+def test_webp_vp8_requires_start_code():
+    data = bytearray(make_webp_vp8(10, 10))
+    data[23:26] = b"\x00\x00\x00"
+    assert read_dimensions(bytes(data), "webp") is None
+
+
+@pytest.mark.parametrize("width, height", [(1, 1), (16384, 1), (1, 16384), (12345, 6789)])
+def test_webp_vp8l_14bit_fields(width, height):
+    assert read_dimensions(make_webp_vp8l(width, height), "webp") == (width, height)
+
+
+def test_webp_vp8l_requires_signature():
+    data = bytearray(make_webp_vp8l(10, 10))
+    data[20] = 0x00
+    assert read_dimensions(bytes(data), "webp") is None
+
+
+@pytest.mark.parametrize("width, height", [(1, 1), (2 ** 24, 3), (70000, 70000)])
+def test_webp_vp8x_24bit_fields(width, height):
+    assert read_dimensions(make_webp_vp8x(width, height), "webp") == (width, height)
+
+
+@pytest.mark.parametrize("make", [make_webp_vp8, make_webp_vp8l, make_webp_vp8x])
+def test_webp_truncated_header(make):
+    assert read_dimensions(make(100, 100)[:-1], "webp") is None
+
+
+def test_webp_unknown_chunk():
+    assert read_dimensions(_riff(b"ALPH", b"\x00" * 20), "webp") is None
+
+
+@pytest.mark.parametrize("lossless", [False, True])
+def test_webp_matches_pillow(lossless):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = BytesIO()
+    Image.new("RGB", (321, 123)).save(buffer, format="WEBP", lossless=lossless)
+    assert read_dimensions(buffer.getvalue(), "webp") == (321, 123)
+
+
+# --- PNG / GIF ---
+
+def test_png_and_gif_sizes():
+    assert read_dimensions(make_png(1920, 1080), "png") == (1920, 1080)
+    assert read_dimensions(make_gif(300, 200), "gif") == (300, 200)
+
+
+def test_png_truncated_or_missing_ihdr():
+    assert read_dimensions(make_png(10, 10)[:20], "png") is None
+    assert read_dimensions(make_png(10, 10).replace(b"IHDR", b"IDAT"), "png") is None
+
+
+def test_gif_truncated():
+    assert read_dimensions(b"GIF89a\x01\x00", "gif") is None
+
+
+# --- validate_image ---
+
+def test_validate_image_accepts_normal_image():
+    info = validate_image(make_jpeg(1024, 768))
+    assert (info.format, info.width, info.height) == ("jpeg", 1024, 768)
+    assert info.mime_type == "image/jpeg" and info.extension == ".jpg"
+
+
+@pytest.mark.parametrize("data", [
+    make_png(50_000, 50_000),          # 解凍爆弾（25億画素）
+    make_webp_vp8x(2 ** 24, 2 ** 24),
+    make_gif(MAX_IMAGE_SIDE + 1, 1),    # 一辺が長すぎる
+    make_jpeg(MAX_IMAGE_SIDE, MAX_IMAGE_PIXELS // MAX_IMAGE_SIDE + 1),
+])
+def test_validate_image_rejects_bomb_dimensions(data):
+    with pytest.raises(ImageValidationError) as e:
+        validate_image(data)
+    assert e.value.status_code == 413
+
+
+def test_validate_image_accepts_pixel_limit_exactly():
+    width = MAX_IMAGE_PIXELS // MAX_IMAGE_SIDE
+    assert validate_image(make_png(width, MAX_IMAGE_SIDE)).height == MAX_IMAGE_SIDE
+
+
+@pytest.mark.parametrize("data, status_code", [
+    (b"", 400),
+    (b"not an image", 415),
+    (make_jpeg(10, 10)[:6], 400),      # ヘッダーが途中で切れている
+    (make_png(0, 10), 400),            # 寸法が0
+    (b"\xff\xd8\xff" + b"\x00" * (MAX_IMAGE_BYTES - 2), 413),
+])
+def test_validate_image_rejections(data, status_code):
+    with pytest.raises(ImageValidationError) as e:
+        validate_image(data)
+    assert e.value.status_code == status_code
+
+
+# --- Content-Length / ファイル名 ---
+
+def test_check_content_length():
+    check_content_length(None)
+    check_content_length("100", limit=100)
+    with pytest.raises(ImageValidationError) as e:
+        check_content_length("101", limit=100)
+    assert e.value.status_code == 413
+    with pytest.raises(ImageValidationError) as e:
+        check_content_length("abc")
+    assert e.value.status_code == 400
+
+
+@pytest.mark.parametrize("filename, expected", [
+    ("lunch.JPG", "lunch.jpg"),
+    ("../../etc/passwd", "passwd.jpg"),
+    ("..\\..\\windows\\win.ini", "win.jpg"),
+    ("朝ごはん.png", "image.jpg"),
+    (None, "image.jpg"),
+    ("a" * 100 + ".jpg", "a" * 64 + ".jpg"),
+])
+def test_safe_filename(filename, expected):
+    assert safe_filename(filename, ".jpg") == expected
+
+
+# --- アップロードサイズの制限（TestClient 経由） ---
+
+MULTIPART_HEADERS = {"content-type": "multipart/form-data; boundary=b"}
+
+
+def multipart_chunks(payload_size, chunk_size=1024 * 1024):
+    """Content-Length を付けずに（chunked で）送る multipart 本文"""
+    yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="a.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'
+    remaining = payload_size
+    while remaining > 0:
+        yield b"\x00" * min(chunk_size, remaining)
+        remaining -= chunk_size
+    yield b"\r\n--b--\r\n"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import main
+    from admission import AdmissionController
+    # レート制限の状態がテスト間で共有されないようにする
+    monkeypatch.setattr(main, "admission_controller", AdmissionController())
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("path", ["/api/analyze", "/analyze-direct"])
+def test_upload_rejected_by_content_length(client, path):
+    response = client.post(path, content=b"x", headers={**MULTIPART_HEADERS, "content-length": str(MAX_IMAGE_BYTES * 2)})
+    assert response.status_code == 413
+    body = response.json()
+    assert body["error"] is True and "ファイルサイズが大きすぎます" in body["message"]
+
+
+def test_upload_with_invalid_content_length(client):
+    response = client.post("/api/analyze", content=b"x", headers={**MULTIPART_HEADERS, "content-length": "abc"})
+    assert response.status_code == 400
+    assert response.json()["error"] is True
+
+
+@pytest.mark.parametrize("path", ["/api/analyze", "/analyze-direct"])
+def test_chunked_upload_cut_off_with_413(client, path):
+    response = client.post(path, content=multipart_chunks(MAX_IMAGE_BYTES * 2), headers=MULTIPART_HEADERS)
+    assert response.status_code == 413
+    body = response.json()
+    assert body["error"] is True and "ファイルサイズが大きすぎます" in body["message"]
+
+
+def test_chunked_upload_under_limit_reaches_handler(client):
+    # 上限内であればミドルウェアを通過し、ハンドラーの画像検証まで届く
+    response = client.post("/api/analyze", content=multipart_chunks(1024), headers=MULTIPART_HEADERS)
+    assert response.status_code == 200
+    assert response.json()["message"].startswith("対応していない画像形式です")
+
+
+def test_size_limit_stops_reading_mid_stream():
+    """上限を超えた時点で受信を打ち切り、残りの本文は読まない"""
+    from main import UploadSizeLimitMiddleware, UploadTooLarge
+
+    messages = [{"type": "http.request", "body": b"x" * 40, "more_body": True} for _ in range(10)]
+    received = []
+
+    async def receive():
+        received.append(1)
+        return messages[len(received) - 1]
+
+    async def downstream(scope, receive, send):
+        while True:
+            message = await receive()
+            if not message.get("more_body"):
+                break
+
+    middleware = UploadSizeLimitMiddleware(downstream, limit=100)
+    scope = {"type": "http", "method": "POST", "path": "/api/analyze", "headers": []}
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(middleware(scope, receive, None))
+    assert len(received) == 3
+
+
+def test_size_limit_includes_multipart_overhead():
+    from main import UploadSizeLimitMiddleware
+    assert UploadSizeLimitMiddleware(None).limit == MAX_IMAGE_BYTES + MULTIPART_OVERHEAD_BYTES
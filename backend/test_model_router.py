@@ -0,0 +1,208 @@
+"""
+model_router のテスト（OpenAI APIは呼び出さず、_call や SDK を差し替えて検証する）
+
+使い方:
+    python -m pytest test_model_router.py
+"""
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import model_router
+from model_router import (
+    MIN_CONFIDENT_LENGTH, ModelRouter, estimate_cost, is_low_confidence, resolve_user_tier
+)
+
+FAST = "fast-model"
+STRONG = "strong-model"
+GOOD_ADVICE = "1. 野菜がたっぷりでバランスが良いです。 2. 汁物を加えるとさらに良くなります。" + "。" * MIN_CONFIDENT_LENGTH
+
+
+class StubCall:
+    """_call の代わりに、モデルごとの応答（または例外）を返す"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def __call__(self, model, messages, max_tokens):
+        self.calls.append((model, max_tokens))
+        response = self.responses[model]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_router(policy="tiered", responses=None):
+    router = ModelRouter(policy=policy, fast_model=FAST, strong_model=STRONG)
+    stub = StubCall(responses or {FAST: (GOOD_ADVICE, "stop"), STRONG: (GOOD_ADVICE, "stop")})
+    router._call = stub
+    return router, stub
+
+
+# --- is_low_confidence ---
+
+@pytest.mark.parametrize("text, finish_reason, markers, expected", [
+    (GOOD_ADVICE, "stop", ("1.", "2."), False),
+    (None, "stop", (), True),
+    ("", "stop", (), True),
+    ("短い応答", "stop", (), True),
+    (GOOD_ADVICE, "length", (), True),            # 打ち切られた応答
+    (GOOD_ADVICE.replace("2.", "・"), "stop", ("1.", "2."), True),  # 見出しが欠けている
+    (GOOD_ADVICE, None, (), False),
+])
+def test_is_low_confidence(text, finish_reason, markers, expected):
+    assert is_low_confidence(text, finish_reason, markers) is expected
+
+
+# --- モデルの選択 ---
+
+def test_fixed_policy_always_uses_strong_model():
+    router, stub = make_router("fixed")
+    result = router.complete([], max_tokens=300, image_size=10)
+    assert (result.model, result.escalated) == (STRONG, False)
+    assert stub.calls == [(STRONG, 300)]
+
+
+@pytest.mark.parametrize("image_size, expected", [
+    (model_router.COMPLEXITY_THRESHOLD_BYTES - 1, FAST),
+    (model_router.COMPLEXITY_THRESHOLD_BYTES, STRONG),
+])
+def test_complexity_policy_uses_image_size(image_size, expected):
+    router, _ = make_router("complexity")
+    assert router.choose_model(image_size=image_size) == expected
+
+
+@pytest.mark.parametrize("tier, expected", [
+    ("premium", STRONG),
+    ("PRO", STRONG),
+    ("free", FAST),
+    (None, FAST),
+])
+def test_user_tier_policy(tier, expected):
+    router, _ = make_router("user_tier")
+    assert router.choose_model(user_tier=tier) == expected
+
+
+def test_unknown_policy_is_rejected():
+    router, _ = make_router()
+    with pytest.raises(ValueError):
+        router.set_policy("cheapest")
+    assert router.policy == "tiered"
+
+
+# --- resolve_user_tier ---
+
+def test_resolve_user_tier_only_trusts_configured_tokens(monkeypatch):
+    monkeypatch.setattr(model_router, "USER_TIER_TOKENS", {"secret-1": "Premium", "secret-2": "pro"})
+    assert resolve_user_tier("secret-1") == "premium"
+    assert resolve_user_tier("secret-2") == "pro"
+    # 区分名そのものを送っても認めない
+    assert resolve_user_tier("premium") is None
+    assert resolve_user_tier("") is None
+    assert resolve_user_tier(None) is None
+
+
+# --- エスカレーション ---
+
+def test_confident_fast_answer_is_not_escalated():
+    router, stub = make_router()
+    result = router.complete([], max_tokens=300, expected_markers=("1.", "2."))
+    assert (result.model, result.escalated, result.attempts) == (FAST, False, [FAST])
+    assert stub.calls == [(FAST, 300)]
+
+
+def test_missing_markers_escalate_with_same_budget():
+    router, stub = make_router(responses={
+        FAST: (GOOD_ADVICE.replace("2.", "・"), "stop"),
+        STRONG: (GOOD_ADVICE, "stop"),
+    })
+    result = router.complete([], max_tokens=300, expected_markers=("1.", "2."))
+    assert (result.model, result.escalated, result.attempts) == (STRONG, True, [FAST, STRONG])
+    assert stub.calls == [(FAST, 300), (STRONG, 300)]
+
+
+def test_truncated_answer_escalates_with_larger_budget(monkeypatch):
+    monkeypatch.setattr(model_router, "ESCALATION_TOKEN_MULTIPLIER", 2.0)
+    router, stub = make_router(responses={FAST: (GOOD_ADVICE, "length"), STRONG: (GOOD_ADVICE, "stop")})
+    result = router.complete([], max_tokens=300)
+    assert result.model == STRONG
+    assert stub.calls == [(FAST, 300), (STRONG, 600)]
+
+
+def test_fast_model_error_falls_back_to_strong_model():
+    router, stub = make_router(responses={FAST: RuntimeError("429 Too Many Requests"), STRONG: (GOOD_ADVICE, "stop")})
+    result = router.complete([], max_tokens=300)
+    assert (result.text, result.model, result.attempts) == (GOOD_ADVICE, STRONG, [FAST, STRONG])
+    assert stub.calls == [(FAST, 300), (STRONG, 300)]
+    assert router.stats()["models"][FAST]["escalations"] == 1
+
+
+def test_before_call_hook_runs_once_per_attempt():
+    router, stub = make_router(responses={FAST: ("短い", "stop"), STRONG: (GOOD_ADVICE, "stop")})
+    hook_calls = []
+    router.complete([], max_tokens=300, before_call=lambda: hook_calls.append(len(stub.calls)))
+    # 各API呼び出しの直前に1回ずつ（エスカレーションで2回）
+    assert hook_calls == [0, 1]
+    assert len(stub.calls) == 2
+
+
+def test_strong_model_error_propagates():
+    router, stub = make_router("fixed", responses={STRONG: RuntimeError("500")})
+    with pytest.raises(RuntimeError):
+        router.complete([], max_tokens=300)
+    assert stub.calls == [(STRONG, 300)]
+
+
+# --- 統計（OpenAI SDKを差し替えて _call を通す） ---
+
+def fake_openai(responses):
+    """model -> (text, finish_reason, prompt_tokens, completion_tokens) または例外"""
+    def create(model, messages, max_tokens):
+        response = responses[model]
+        if isinstance(response, Exception):
+            raise response
+        text, finish_reason, prompt_tokens, completion_tokens = response
+        return SimpleNamespace(
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens),
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason=finish_reason)],
+        )
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_stats_count_calls_tokens_cost_and_escalations(monkeypatch):
+    monkeypatch.setitem(sys.modules, "openai", fake_openai({
+        "gpt-4o-mini": ("短い", "stop", 1000, 10),
+        "gpt-4o": (GOOD_ADVICE, "stop", 1000, 200),
+    }))
+    router = ModelRouter(policy="tiered", fast_model="gpt-4o-mini", strong_model="gpt-4o")
+    router.complete([], max_tokens=300)
+    router.complete([], max_tokens=300)
+
+    stats = router.stats()
+    fast, strong = stats["models"]["gpt-4o-mini"], stats["models"]["gpt-4o"]
+    assert (fast["calls"], fast["escalations"], fast["errors"]) == (2, 2, 0)
+    assert (strong["calls"], strong["escalations"]) == (2, 0)
+    assert (fast["prompt_tokens"], fast["completion_tokens"]) == (2000, 20)
+    assert strong["cost_usd"] == pytest.approx(2 * estimate_cost("gpt-4o", 1000, 200))
+    assert stats["total_cost_usd"] == pytest.approx(fast["cost_usd"] + strong["cost_usd"])
+
+    router.reset_stats()
+    assert router.stats()["models"] == {}
+
+
+def test_stats_count_errors(monkeypatch):
+    monkeypatch.setitem(sys.modules, "openai", fake_openai({
+        "gpt-4o-mini": RuntimeError("unknown model"),
+        "gpt-4o": (GOOD_ADVICE, "stop", 500, 100),
+    }))
+    router = ModelRouter(policy="tiered", fast_model="gpt-4o-mini", strong_model="gpt-4o")
+    assert router.complete([], max_tokens=300).model == "gpt-4o"
+    fast = router.stats()["models"]["gpt-4o-mini"]
+    assert (fast["calls"], fast["errors"], fast["escalations"]) == (1, 1, 1)
+
+
+def test_estimate_cost_falls_back_to_strong_model_pricing():
+    assert estimate_cost("gpt-4o-mini", 1_000_000, 1_000_000) == pytest.approx(0.75)
+    assert estimate_cost("unknown", 1_000_000, 0) == pytest.approx(2.50)
@@ -0,0 +1,116 @@
+"""
+renditions のテスト（画像はPillowでメモリ上に生成する）
+
+使い方:
+    python -m pytest test_renditions.py
+"""
+import asyncio
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from renditions import (
+    RENDITION_SIZES, collect_renditions, discard_renditions, render_renditions, rendition_paths, start_renditions
+)
+
+
+def make_image(width, height, mode="RGB", format="JPEG", orientation=None):
+    """指定サイズの画像を生成する（orientation を指定するとEXIFに書き込む）"""
+    image = Image.new(mode, (width, height), 128 if mode in ("P", "L") else None)
+    buffer = BytesIO()
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(buffer, format=format, exif=exif)
+    else:
+        image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def decode(data):
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+
+# --- render_renditions ---
+
+def test_renditions_fit_within_each_size_and_keep_aspect_ratio():
+    renditions = render_renditions(make_image(4000, 3000))
+    assert list(renditions) == list(RENDITION_SIZES)
+    for name, max_side in RENDITION_SIZES.items():
+        image = decode(renditions[name])
+        assert image.format == "WEBP"
+        assert image.size == (max_side, max_side * 3 // 4)
+
+
+def test_small_image_is_not_upscaled():
+    renditions = render_renditions(make_image(200, 100))
+    assert decode(renditions["medium"]).size == (200, 100)
+    assert decode(renditions["thumbnail"]).size == (200, 100)
+
+
+def test_exif_orientation_is_applied():
+    # orientation=6（90度回転）の横長画像は、縦長の縮小画像になる
+    renditions = render_renditions(make_image(1600, 1200, orientation=6))
+    assert decode(renditions["medium"]).size == (960, 1280)
+    assert decode(renditions["thumbnail"]).size == (240, 320)
+
+
+@pytest.mark.parametrize("mode, format, expected_mode", [
+    ("RGBA", "PNG", "RGBA"),   # 透過を保つ
+    ("P", "PNG", "RGB"),
+    ("P", "GIF", "RGB"),
+    ("L", "JPEG", "RGB"),
+])
+def test_non_rgb_input_is_converted(mode, format, expected_mode):
+    renditions = render_renditions(make_image(640, 480, mode=mode, format=format))
+    thumbnail = decode(renditions["thumbnail"])
+    assert thumbnail.size == (320, 240)
+    assert thumbnail.mode == expected_mode
+
+
+# --- rendition_paths ---
+
+@pytest.mark.parametrize("original, stem", [
+    ("abc123_1700000000.jpg", "abc123_1700000000"),
+    ("meals/0f8c_meal.png", "meals/0f8c_meal"),
+    ("external/5d41402abc4b2a76", "external/5d41402abc4b2a76"),
+])
+def test_rendition_paths_are_keyed_to_original(original, stem):
+    assert rendition_paths(original) == {
+        "medium": f"renditions/{stem}_medium.webp",
+        "thumbnail": f"renditions/{stem}_thumbnail.webp",
+    }
+
+
+# --- start / collect / discard ---
+
+def test_start_and_collect_renditions():
+    async def scenario():
+        future = start_renditions(make_image(640, 480))
+        renditions = await collect_renditions(future)
+        discard_renditions(future)
+        return renditions
+    assert set(asyncio.run(scenario())) == set(RENDITION_SIZES)
+
+
+def test_collect_returns_empty_dict_for_broken_image():
+    async def scenario():
+        return await collect_renditions(start_renditions(b"not an image"))
+    assert asyncio.run(scenario()) == {}
+
+
+def test_discard_cancels_pending_and_retrieves_failed_futures():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        pending = loop.create_future()
+        discard_renditions(pending)
+        assert pending.cancelled()
+
+        failed = start_renditions(b"not an image")
+        await asyncio.gather(failed, return_exceptions=True)
+        discard_renditions(failed)
+        discard_renditions(None)
+    asyncio.run(scenario())
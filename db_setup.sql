@@ -4,13 +4,22 @@ CREATE TABLE IF NOT EXISTS meal_images (
     filename TEXT NOT NULL,
     public_url TEXT NOT NULL,
     analysis_result TEXT,
+    prompt_version TEXT,
+    thumbnail_url TEXT,
+    medium_url TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     user_id UUID
 );
 
+-- 既存テーブルへのマイグレーション
+ALTER TABLE meal_images ADD COLUMN IF NOT EXISTS prompt_version TEXT;
+ALTER TABLE meal_images ADD COLUMN IF NOT EXISTS thumbnail_url TEXT;
+ALTER TABLE meal_images ADD COLUMN IF NOT EXISTS medium_url TEXT;
+
 -- インデックスの作成
 CREATE INDEX IF NOT EXISTS meal_images_user_id_idx ON meal_images(user_id);
 CREATE INDEX IF NOT EXISTS meal_images_created_at_idx ON meal_images(created_at DESC);
+CREATE INDEX IF NOT EXISTS meal_images_prompt_version_idx ON meal_images(prompt_version);
 
 -- RLS (Row Level Security) ポリシーの設定
 -- すべてのユーザーが読み取り可能
@@ -32,6 +41,26 @@ CREATE POLICY "管理者はすべてのデータにアクセス可能" ON meal_i
     USING (true)
     WITH CHECK (true);
 
+-- バックフィル用の一括更新（既存の行だけを更新し、途中で削除された行は再作成しない）
+CREATE OR REPLACE FUNCTION bulk_update_analysis(updates JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH updated AS (
+        UPDATE meal_images AS m
+        SET analysis_result = u.analysis_result,
+            prompt_version = u.prompt_version
+        FROM jsonb_to_recordset(updates) AS u(id UUID, analysis_result TEXT, prompt_version TEXT)
+        WHERE m.id = u.id
+        RETURNING m.id
+    )
+    SELECT count(*)::INTEGER FROM updated;
+$$;
+
+-- 一括更新はサービスキー（service_role）からのみ実行可能
+REVOKE EXECUTE ON FUNCTION bulk_update_analysis(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION bulk_update_analysis(JSONB) TO service_role;
+
 -- コメント
 COMMENT ON TABLE meal_images IS '食事画像のメタデータを保存するテーブル';
 COMMENT ON COLUMN meal_images.id IS '一意のID';
@@ -39,4 +68,7 @@ COMMENT ON COLUMN meal_images.filename IS '画像のファイル名';
 COMMENT ON COLUMN meal_images.public_url IS '公開URL';
 COMMENT ON COLUMN meal_images.analysis_result IS 'GPT-4oによる分析結果';
 COMMENT ON COLUMN meal_images.created_at IS '作成日時';
-COMMENT ON COLUMN meal_images.user_id IS 'ユーザーID（認証済みの場合）'; 
\ No newline at end of file
+COMMENT ON COLUMN meal_images.user_id IS 'ユーザーID（認証済みの場合）';
+COMMENT ON COLUMN meal_images.prompt_version IS '分析に使用したプロンプトのバージョン（例: advice@v1）';
+COMMENT ON COLUMN meal_images.thumbnail_url IS 'サムネイル（長辺320px・WebP）の公開URL';
+COMMENT ON COLUMN meal_images.medium_url IS '中サイズ（長辺1280px・WebP）の公開URL';
\ No newline at end of file